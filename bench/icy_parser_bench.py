@@ -0,0 +1,58 @@
+"""Throughput of IcyMetadataParser.feed on a synthetic ICY stream.
+
+Run from the repository root with: python bench/icy_parser_bench.py [--metaint N] [--chunk N] [--mb N]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bot import IcyMetadataParser # noqa: E402
+
+def build_stream(metaint: int, size: int) -> bytes:
+    rng = random.Random(0)
+    audio = rng.randbytes(metaint)
+    stream = bytearray()
+    n = 0
+    while len(stream) < size:
+        stream += audio
+        if n % 4: # Most blocks are empty, as on real stations between title changes
+            stream.append(0)
+        else:
+            block = f"StreamTitle='Artist {n} - Song {n}';StreamUrl='';".encode()
+            block += b'\0' * (-len(block) % 16)
+            stream.append(len(block) // 16)
+            stream += block
+        n += 1
+    return bytes(stream)
+
+def run(stream: bytes, metaint: int, chunk: int, audio_out: bool) -> tuple[float, int]:
+    parser = IcyMetadataParser(metaint)
+    out = bytearray() if audio_out else None
+    records = 0
+    started = time.perf_counter()
+    for pos in range(0, len(stream), chunk):
+        records += len(parser.feed(stream[pos:pos + chunk], out))
+        if out is not None:
+            out.clear() # Like IcyStreamPipe, which hands the audio on after every read
+    return time.perf_counter() - started, records
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--metaint', type=int, default=16000)
+    parser.add_argument('--chunk', type=int, default=8192, help="bytes per feed() call")
+    parser.add_argument('--mb', type=int, default=64, help="stream size in MiB")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    stream = build_stream(args.metaint, args.mb * 1024 * 1024)
+    for audio_out in (False, True):
+        best, records = min(run(stream, args.metaint, args.chunk, audio_out) for _ in range(args.repeat))
+        mode = 'audio_out' if audio_out else 'skip audio'
+        print(f"{mode:>10}: {len(stream) / best / 1024 / 1024:8.1f} MiB/s, {len(stream) // args.chunk / best:10.0f} feeds/s "
+              f"({records} records, metaint={args.metaint}, chunk={args.chunk})")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""RSS per 1,000 guilds under each RUNTIME_PROFILE's intents and cache settings.
+
+Builds synthetic GUILD_CREATE payloads (channels, members, voice states, emojis and stickers, which
+the gateway sends whatever the intents) and loads them into discord.py's cache the way the gateway
+would, then reports the RSS growth. Each profile runs with its real defaults unless overridden. No Discord connection or token is needed. Each profile runs in
+its own process because the profile is read when bot.py is imported.
+
+Run from the repository root with: python bench/memory_bench.py [--guilds N] [--members N] [--emojis N]
+"""
+import argparse
+import gc
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROFILES = ('standard', 'lean')
+
+def guild_payload(guild_id: int, members: int, in_voice: int, emojis: int, stickers: int) -> dict:
+    text_id, voice_id = guild_id * 10 + 1, guild_id * 10 + 2
+    users = [{'id': str(guild_id * 1000 + i), 'username': f"user{i}", 'discriminator': '0', 'avatar': None}
+             for i in range(members)]
+    return {
+        'id': str(guild_id), 'name': f"Guild {guild_id}", 'owner_id': users[0]['id'], 'member_count': members,
+        'features': [], 'unavailable': False,
+        'emojis': [{'id': str(guild_id * 1000 + i), 'name': f"emoji{i}", 'roles': [], 'require_colons': True,
+                    'managed': False, 'animated': False, 'available': True} for i in range(emojis)],
+        'stickers': [{'id': str(guild_id * 1000 + 500 + i), 'name': f"sticker{i}", 'description': '', 'tags': 'radio',
+                      'type': 2, 'format_type': 1, 'available': True, 'guild_id': str(guild_id)} for i in range(stickers)],
+        'roles': [{'id': str(guild_id), 'name': '@everyone', 'permissions': '0', 'position': 0, 'color': 0,
+                   'hoist': False, 'managed': False, 'mentionable': False}],
+        'channels': [
+            {'id': str(text_id), 'type': 0, 'name': 'general', 'position': 0, 'permission_overwrites': []},
+            {'id': str(voice_id), 'type': 2, 'name': 'Radio', 'position': 1, 'permission_overwrites': [],
+             'bitrate': 64000, 'user_limit': 0},
+        ],
+        'members': [{'user': user, 'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0}
+                    for user in users],
+        'voice_states': [{'user_id': user['id'], 'channel_id': str(voice_id), 'session_id': 'x', 'deaf': False,
+                          'mute': False, 'self_deaf': False, 'self_mute': False, 'suppress': False}
+                         for user in users[:in_voice]],
+    }
+
+def message_payload(message_id: int, channel_id: int, author: dict) -> dict:
+    return {'id': str(message_id), 'channel_id': str(channel_id), 'author': author, 'content': ',,play example',
+            'timestamp': '2024-01-01T00:00:00+00:00', 'edited_timestamp': None, 'tts': False,
+            'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [],
+            'pinned': False, 'type': 0}
+
+def measure(args) -> None:
+    """Runs inside the child process for one profile."""
+    sys.path.insert(0, ROOT)
+    import bot # Reads RUNTIME_PROFILE from the environment
+
+    state = bot.bot._connection
+    gc.collect()
+    before = bot.process_rss_bytes()
+    for n in range(args.guilds):
+        guild_id = 10**17 + n
+        payload = guild_payload(guild_id, args.members, args.in_voice, args.emojis, args.stickers)
+        guild = state._add_guild_from_data(payload)
+        if state._messages is not None: # Only when the profile keeps a message cache
+            channel = guild.text_channels[0]
+            for i in range(args.messages):
+                message = bot.discord.Message(state=state, channel=channel,
+                                              data=message_payload(guild_id * 1000 + i, channel.id, payload['members'][0]['user']))
+                state._messages.append(message)
+    gc.collect()
+    after = bot.process_rss_bytes()
+    if before is None or after is None:
+        print(f"{bot.RUNTIME_PROFILE:>8}: RSS unavailable on this platform")
+        return
+    per_thousand = (after - before) / args.guilds * 1000 / 2**20
+    print(f"{bot.RUNTIME_PROFILE:>8}: {per_thousand:7.1f} MiB per 1,000 guilds "
+          f"({args.guilds} guilds, {sum(len(g._members) for g in state.guilds)} cached members, "
+          f"{len(state._emojis) + len(state._stickers)} cached emojis/stickers, {len(state._messages or ())} cached messages, "
+          f"total RSS {after / 2**20:.1f} MiB)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=2000)
+    parser.add_argument('--members', type=int, default=50, help="members per GUILD_CREATE payload")
+    parser.add_argument('--in-voice', type=int, default=2, help="of those, members sitting in the voice channel")
+    parser.add_argument('--emojis', type=int, default=30, help="custom emojis per guild")
+    parser.add_argument('--stickers', type=int, default=3, help="stickers per guild")
+    parser.add_argument('--messages', type=int, default=20, help="messages per guild offered to the message cache, if any")
+    parser.add_argument('--message-cache-size', help="MESSAGE_CACHE_SIZE for the standard profile (default: the bot's own)")
+    parser.add_argument('--profile', choices=PROFILES, help="measure one profile in this process")
+    args = parser.parse_args()
+
+    if args.profile:
+        measure(args)
+        return
+    for profile in PROFILES:
+        env = dict(os.environ, RUNTIME_PROFILE=profile)
+        if args.message_cache_size is not None:
+            env['MESSAGE_CACHE_SIZE'] = args.message_cache_size
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--profile', profile] + sys.argv[1:], env=env, check=True)
+
+if __name__ == '__main__':
+    main()
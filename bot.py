@@ -2,12 +2,25 @@ import discord
 from discord.ext import commands, tasks
 import os
 import asyncio
+import collections
 import functools
+import itertools
 import logging
+import threading
+import types
 import json # For state persistence
+import sqlite3 # Optional state backend
+import subprocess
 import datetime
+import hashlib
+import io
+import sys
+import time
+import random
 import re # For parsing metadata
+import urllib.parse
 import aiohttp # For fetching metadata
+from aiohttp import web # Optional /metrics endpoint
 from dotenv import load_dotenv
 
 # --- Basic Logging Setup ---
@@ -19,11 +32,68 @@ logger = logging.getLogger('discord_bot')
 load_dotenv()
 BOT_TOKEN = os.getenv('DISCORD_TOKEN')
 COMMAND_PREFIX = ",,"
-RECONNECT_DELAY = 5
+RECONNECT_DELAY = 5 # Base delay before a reconnect, doubled per attempt with jitter
+RECONNECT_DELAY_MAX = 120 # Upper bound for a single reconnect delay
 MAX_RECONNECT_ATTEMPTS = 3
+PLAYBACK_STABLE_AFTER = 15 # Seconds of uninterrupted playback after which retries reset and the stream counts as healthy
+STREAM_CIRCUIT_FAILURE_THRESHOLD = 5 # Consecutive playback failures on one stream URL (any guild) that open its circuit
+STREAM_CIRCUIT_OPEN_MIN = 15 # Seconds an opened circuit waits before probing the stream
+STREAM_CIRCUIT_OPEN_MAX = 600 # Upper bound for the wait, doubled after each failed probe
+STREAM_CIRCUIT_PROBE_TIMEOUT = 10 # Seconds allowed for the half-open probe request
+STREAM_CIRCUIT_MAX_WAIT = 1800 # Seconds a guild waits on an open circuit before giving up
 STOP_REACTION = '⏹️'
+MESSAGE_CACHE_SIZE = int(os.getenv('MESSAGE_CACHE_SIZE', '0')) # discord.py message cache, 0 disables it (reactions use raw events)
+RUNTIME_PROFILE = os.getenv('RUNTIME_PROFILE', 'standard').lower() # 'standard', or 'lean' for minimal intents and caches
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'json').lower() # 'json' (STATE_FILE) or 'sqlite' (STATE_DB_FILE)
 STATE_FILE = 'state.json' # File for persistence
-METADATA_FETCH_INTERVAL = 30 # Seconds between metadata checks
+STATE_DB_FILE = 'state.db' # SQLite database for persistence, can be shared by several bot processes
+STATE_DB_BUSY_TIMEOUT = 10 # Seconds to wait for another process holding the SQLite write lock
+RESUME_CONCURRENCY = int(os.getenv('RESUME_CONCURRENCY', '5')) # Auto-resumes in flight at once after a restart
+RESUME_RATE = float(os.getenv('RESUME_RATE', '2')) # Auto-resumes started per second
+RESUME_PROGRESS_INTERVAL = 10 # Seconds between auto-resume progress log lines
+REQUESTER_CACHE_SIZE = 1024 # Requester users kept for Now Playing embeds
+REQUESTER_CACHE_TTL = 3600 # Seconds a fetched requester stays cached
+REQUESTER_CACHE_NEGATIVE_TTL = 300 # Seconds a requester that couldn't be found stays cached
+EMBED_UPDATE_WORKERS = 4 # Now Playing renders running at once
+EMBED_EDITS_PER_SECOND = 0.5 # Sustained Now Playing sends/edits per text channel
+EMBED_EDIT_BURST = 3 # Extra renders a channel may use in a burst
+EMBED_BUCKET_LIMIT = 4096 # Channel rate buckets kept before idle ones are forgotten
+EMBED_RENDER_CACHE_SIZE = 256 # Distinct rendered Now Playing embeds kept for reuse
+STATE_SAVE_DEBOUNCE = 1.0 # Seconds of state changes coalesced into one write
+METADATA_SYNC_INTERVAL = 30 # Seconds between checks that every playing stream has a metadata reader
+METADATA_CONNECT_CONCURRENCY = 20 # Max metadata connections being opened at the same time
+ICY_READER_BACKOFF_MIN = 2 # Seconds before a dropped metadata connection is retried
+ICY_READER_BACKOFF_MAX = 300 # Upper bound for the doubling retry delay
+ICY_INLINE_METADATA = os.getenv('ICY_INLINE_METADATA', '1') == '1' # Read titles from the playback connection instead of a second one
+ICY_PIPE_CHUNK_SIZE = 8192 # Bytes read from upstream per call when feeding FFmpeg ourselves
+ICY_PIPE_READ_TIMEOUT = 30 # Seconds without upstream data before the connection is considered dead
+ICY_PIPE_RECONNECT_ATTEMPTS = 3 # Upstream reconnects tried before the shared decoder is failed
+STREAM_HUB_BUFFER_FRAMES = 250 # Frames (20ms each) buffered per guild from a shared decoder
+STREAM_HUB_READ_TIMEOUT = 15 # Seconds a guild waits for audio from a shared decoder before giving up
+STREAM_HUB_FRAME_SECONDS = 0.02 # Audio per frame; shared decoders hand frames out at this pace
+STREAM_HUB_MAX_CATCHUP = 0.2 # Seconds a shared decoder may fall behind real time before its clock is reset instead of bursting
+STREAM_HUB_EXIT_TIMEOUT = 2 # Seconds to wait for FFmpeg's exit code once its output ended
+PLAYBACK_ENGINE = os.getenv('PLAYBACK_ENGINE', 'pcm').lower() # 'pcm' (discord.py encodes Opus) or 'opus' (FFmpeg copies/encodes Opus)
+OPUS_BITRATE = 128 # kbps, used when FFmpeg has to encode a non-Opus stream
+FFMPEG_RECONNECT_OPTIONS = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+PROBE_CACHE_FILE = 'probe_cache.json' # Per-URL stream probe results
+PROBE_CACHE_TTL = 7 * 24 * 3600 # Seconds before a cached probe is re-done
+PROBE_CACHE_PROBESIZE = 32768 # Bytes FFmpeg reads before starting when the stream is already known
+PROBE_CACHE_FAILURE_WINDOW = 15 # Playback failing within this many seconds of starting invalidates the cached probe
+PROBE_TIMEOUT = 20 # Seconds allowed for ffprobe
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0')) # Port for the Prometheus /metrics endpoint, 0 disables it
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+LOOP_LAG_INTERVAL = 1.0 # Seconds between event loop lag samples
+LOOP_LAG_HISTORY = 300 # Lag samples kept for the diag command's percentiles
+LOOP_SLOW_CALLBACK = float(os.getenv('LOOP_SLOW_CALLBACK', '0.1')) # Seconds one loop callback may run before it's logged and attributed, 0 disables
+TTFA_HISTORY = 500 # Completed time-to-first-audio traces kept per trigger for percentiles
+PROFILE_INTERVAL = 0.005 # Seconds between profiler samples while ,,profile runs
+PROFILE_MAX_SECONDS = 60 # Longest profile the command accepts
+ASYNCIO_DEBUG = os.getenv('ASYNCIO_DEBUG', '0') == '1' # asyncio debug mode (slow, adds coroutine origins to asyncio's own warnings)
+
+if RESUME_CONCURRENCY < 1 or not RESUME_RATE > 0: # 0 would deadlock the resume semaphore or divide by zero
+    logger.critical(f"RESUME_CONCURRENCY must be at least 1 and RESUME_RATE above 0 (got {RESUME_CONCURRENCY} and {RESUME_RATE}).")
+    sys.exit(1)
 
 # --- Predefined Radio Streams ---
 PREDEFINED_STREAMS = {
@@ -31,130 +101,1231 @@ PREDEFINED_STREAMS = {
 }
 
 # --- Intents ---
-intents = discord.Intents.default()
-intents.message_content = True
-intents.voice_states = True
-intents.guilds = True
-intents.reactions = True
+if RUNTIME_PROFILE == 'lean':
+    # Only what a radio bot uses: channels, voice states, prefix commands and the stop reaction
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.voice_states = True
+    intents.guild_messages = True
+    intents.message_content = True
+    intents.guild_reactions = True
+    # Only members sitting in voice channels are cached (listener counts, ctx.author.voice still work);
+    # everything else, e.g. requesters, goes through our own caches with REST fallback
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.voice = True
+    max_messages = None
+else:
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.voice_states = True
+    intents.guilds = True
+    intents.reactions = True
+    member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+    max_messages = MESSAGE_CACHE_SIZE or None
 
 # --- Bot Initialization ---
-bot = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents, help_command=None)
+bot = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents, help_command=None, max_messages=max_messages,
+                   member_cache_flags=member_cache_flags, chunk_guilds_at_startup=intents.members)
 # Use aiohttp ClientSession for efficient HTTP requests
 bot.http_session = None # Will be initialized in on_ready
 
+# --- Metrics ---
+# Minimal Prometheus text-format metrics, no client library needed. Counters and histograms are updated
+# where things happen (some from worker threads, hence the locks); gauges are read at scrape time.
+
+def _format_labels(labels: dict) -> str:
+    if not labels: return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name, self.help_text = name, help_text
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(dict(key))} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple):
+        self.name, self.help_text = name, help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {} # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1 # Stored per bucket, made cumulative when rendered
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in self._series.items():
+                labels = dict(key)
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': bound})} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {series[-1]}")
+        return lines
+
+class Gauge:
+    """Read at scrape time: read() returns a number (None to skip), or a dict of label tuples -> number.
+
+    metric_type='counter' exposes a running total kept elsewhere, e.g. in a component's stats().
+    """
+
+    def __init__(self, name: str, help_text: str, read, metric_type: str = 'gauge'):
+        self.name, self.help_text, self.read, self.metric_type = name, help_text, read, metric_type
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        value = self.read()
+        if isinstance(value, dict):
+            for key, v in value.items():
+                lines.append(f"{self.name}{_format_labels(dict(key))} {v}")
+        elif value is not None:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        metric = Counter(name, help_text); self._metrics.append(metric); return metric
+
+    def histogram(self, name: str, help_text: str, buckets: tuple) -> Histogram:
+        metric = Histogram(name, help_text, buckets); self._metrics.append(metric); return metric
+
+    def gauge(self, name: str, help_text: str, read, metric_type: str = 'gauge') -> Gauge:
+        metric = Gauge(name, help_text, read, metric_type); self._metrics.append(metric); return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e: # One broken gauge shouldn't fail the whole scrape
+                logger.warning(f"Failed to render metric {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+reconnect_attempts = metrics.counter('radio_reconnect_attempts_total', 'Playback recoveries started, by reason.')
+reconnect_failures = metrics.counter('radio_reconnect_failures_total', 'Playback recoveries that gave up or failed, by reason.')
+metadata_fetch_seconds = metrics.histogram('radio_metadata_fetch_seconds', 'Time to open a stream connection that carries ICY metadata.', LATENCY_BUCKETS)
+metadata_errors = metrics.counter('radio_metadata_errors_total', 'Failed metadata connections and reads, by source and error.')
+embed_rest_calls = metrics.counter('radio_embed_rest_calls_total', 'Now Playing REST calls, by call and outcome.')
+state_save_seconds = metrics.histogram('radio_state_save_seconds', 'Duration of state backend writes.', LATENCY_BUCKETS)
+ttfa_seconds = metrics.histogram('radio_ttfa_seconds', 'Time from a play/reconnect/resume request to the first audio frame, by trigger.', LATENCY_BUCKETS)
+ttfa_stage_seconds = metrics.histogram('radio_ttfa_stage_seconds', 'Duration of each stage on the way to the first audio frame, by trigger and stage.', LATENCY_BUCKETS)
+slow_callbacks = metrics.counter('radio_slow_callbacks_total', 'Event loop callbacks that ran longer than LOOP_SLOW_CALLBACK.')
+loop_lag_seconds = metrics.histogram('radio_event_loop_lag_seconds', 'How late the event loop ran a timer.', LATENCY_BUCKETS)
+
 # --- Guild Playback State ---
-# In-memory cache, loaded from/saved to STATE_FILE
-# {guild_id: {"vc": vc|None, "url": str, "stream_name": str, "should_play": bool, "retries": int,
-#             "requester_id": int|None, "text_channel_id": int|None, "voice_channel_id": int|None,
-#             "now_playing_message_id": int|None, "current_metadata": str|None, "is_resuming": bool}}
-guild_states = {}
+# In-memory cache, loaded from/saved to the state backend
+
+class GuildState:
+    """Playback state of one guild.
+
+    url, should_play and now_playing_message_id are properties so that the owning
+    GuildStateRegistry can keep its secondary indexes up to date.
+    """
+
+    __slots__ = ('guild_id', '_registry', 'vc', 'stream_name', 'retries', 'requester_id', 'text_channel_id',
+                 'voice_channel_id', 'now_playing_message', 'now_playing_hash', 'current_metadata', 'is_resuming',
+                 'playback_started_at', '_url', '_should_play', '_now_playing_message_id')
+
+    def __init__(self, guild_id: int, registry: 'GuildStateRegistry'):
+        self.guild_id = guild_id
+        self._registry = registry
+        self.vc: discord.VoiceClient | None = None
+        self.stream_name: str | None = None
+        self.retries = 0
+        self.requester_id: int | None = None
+        self.text_channel_id: int | None = None
+        self.voice_channel_id: int | None = None
+        self.now_playing_message: discord.PartialMessage | None = None
+        self.now_playing_hash: str | None = None # Content hash of what the Now Playing message currently shows
+        self.current_metadata: str | None = None
+        self.is_resuming = False # True while the state came from persistence and hasn't played yet
+        self.playback_started_at: float | None = None
+        self._url = None
+        self._should_play = False
+        self._now_playing_message_id = None
+
+    @property
+    def url(self) -> str | None:
+        return self._url
+
+    @url.setter
+    def url(self, value: str | None):
+        self._registry._move(self._registry._by_url, self._url, value, self.guild_id, many=True)
+        self._url = value
+
+    @property
+    def should_play(self) -> bool:
+        return self._should_play
+
+    @should_play.setter
+    def should_play(self, value: bool):
+        if value: self._registry.playing.add(self.guild_id)
+        else: self._registry.playing.discard(self.guild_id)
+        self._should_play = value
+
+    @property
+    def now_playing_message_id(self) -> int | None:
+        return self._now_playing_message_id
+
+    @now_playing_message_id.setter
+    def now_playing_message_id(self, value: int | None):
+        self._registry._move(self._registry._by_message, self._now_playing_message_id, value, self.guild_id)
+        self._now_playing_message_id = value
+
+class GuildStateRegistry:
+    """All GuildStates by guild ID, plus indexes so hot paths only touch the guilds they care about."""
+
+    def __init__(self):
+        self._states: dict[int, GuildState] = {}
+        self._by_url: dict[str, set[int]] = {}
+        self._by_message: dict[int, int] = {} # Now Playing message ID -> guild ID
+        self.playing: set[int] = set() # Guilds with should_play=True
+
+    @staticmethod
+    def _move(index: dict, old, new, guild_id: int, many: bool = False):
+        if old == new: return
+        if old is not None:
+            if many:
+                guild_ids = index.get(old)
+                if guild_ids is not None:
+                    guild_ids.discard(guild_id)
+                    if not guild_ids: del index[old]
+            elif index.get(old) == guild_id:
+                del index[old]
+        if new is not None:
+            if many: index.setdefault(new, set()).add(guild_id)
+            else: index[new] = guild_id
+
+    def get(self, guild_id: int) -> GuildState | None:
+        return self._states.get(guild_id)
+
+    def __getitem__(self, guild_id: int) -> GuildState:
+        return self._states[guild_id]
+
+    def __contains__(self, guild_id: int) -> bool:
+        return guild_id in self._states
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def get_or_create(self, guild_id: int) -> GuildState:
+        state = self._states.get(guild_id)
+        if state is None:
+            state = self._states[guild_id] = GuildState(guild_id, self)
+        return state
+
+    def items(self) -> list[tuple[int, GuildState]]:
+        return list(self._states.items()) # Copy, callers may await while iterating
+
+    def values(self) -> list[GuildState]:
+        return list(self._states.values())
+
+    def clear(self):
+        self.__init__()
+
+    def guilds_for_url(self, stream_url: str) -> set[int]:
+        return set(self._by_url.get(stream_url, ()))
+
+    def guild_for_message(self, message_id: int) -> int | None:
+        return self._by_message.get(message_id)
+
+    def playing_states(self) -> list[GuildState]:
+        return [self._states[guild_id] for guild_id in list(self.playing)]
+
+guild_states = GuildStateRegistry()
 
 # --- Persistence Functions ---
 
-def save_state():
-    """Saves the relevant parts of guild_states to state.json for persistence."""
+def persistent_record(guild_id: int) -> dict | None:
+    """Returns the persistable part of a guild's state, or None if it shouldn't be stored."""
+    state = guild_states.get(guild_id)
+    # Only save if the bot is supposed to be playing
+    if not state or not (state.should_play and state.voice_channel_id and state.url):
+        logger.debug(f"[{guild_id}] Skipping save for guild state (should_play=False or missing info).")
+        return None
+    logger.debug(f"[{guild_id}] Preparing to save state: VC={state.voice_channel_id}, URL={state.url}")
+    return {
+        'voice_channel_id': state.voice_channel_id,
+        'text_channel_id': state.text_channel_id, # Store text channel too
+        'stream_url': state.url,
+        'stream_name': state.stream_name or state.url, # Fallback to URL if name missing
+        'requester_id': state.requester_id, # Store requester ID
+    }
+
+def build_persistent_state() -> dict:
+    """Snapshots every persistable guild state into a JSON-ready dict."""
     persistent_state = {}
-    for guild_id, state in guild_states.items():
-        # Only save if the bot is supposed to be playing
-        if state.get('should_play') and state.get('voice_channel_id') and state.get('url'):
-            persistent_state[str(guild_id)] = {
-                'voice_channel_id': state['voice_channel_id'],
-                'text_channel_id': state.get('text_channel_id'), # Store text channel too
-                'stream_url': state['url'],
-                'stream_name': state.get('stream_name', state['url']), # Fallback to URL if name missing
-                'requester_id': state.get('requester_id'), # Store requester ID
-            }
-            logger.debug(f"[{guild_id}] Preparing to save state: VC={state['voice_channel_id']}, URL={state['url']}")
-        else:
-            logger.debug(f"[{guild_id}] Skipping save for guild state (should_play=False or missing info).")
+    for guild_id, _ in guild_states.items():
+        record = persistent_record(guild_id)
+        if record:
+            persistent_state[str(guild_id)] = record
+    return persistent_state
+
+def write_file_atomic(path: str, data: str):
+    """Replaces path with data via a synced temp file, so readers and crashes never see a half-written file."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+class JsonStateBackend:
+    """Stores all guilds in one JSON file, rewritten (atomically) on every change."""
+
+    full_snapshot = True # write() needs every guild, not just the changed ones
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self, bot_id: int) -> dict:
+        if not os.path.exists(self.path):
+            logger.info(f"{self.path} not found, starting with empty state.")
+            return {}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def write(self, changes: dict, snapshot: dict | None):
+        write_file_atomic(self.path, json.dumps(snapshot))
+
+class SqliteStateBackend:
+    """Stores one row per guild in SQLite (WAL mode), so a write costs O(changed guilds).
+
+    Rows are keyed by (bot_id, guild_id), letting several bot processes on one host share the file.
+    """
+
+    full_snapshot = False
+
+    def __init__(self, path: str):
+        self.path = path
+        self.bot_id = None # Set by load(), once the bot knows who it is
+        # Writes come from worker threads, StateWriter makes sure only one runs at a time
+        self._conn = sqlite3.connect(path, timeout=STATE_DB_BUSY_TIMEOUT, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL") # Readers and other processes don't block on writers
+        self._conn.execute("PRAGMA synchronous=NORMAL") # Durable across process crashes, cheap fsyncs in WAL mode
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS guild_state (
+                bot_id INTEGER NOT NULL,
+                guild_id INTEGER NOT NULL,
+                voice_channel_id INTEGER NOT NULL,
+                text_channel_id INTEGER,
+                stream_url TEXT NOT NULL,
+                stream_name TEXT,
+                requester_id INTEGER,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (bot_id, guild_id)
+            )""")
+
+    def load(self, bot_id: int) -> dict:
+        self.bot_id = bot_id
+        rows = self._conn.execute(
+            "SELECT guild_id, voice_channel_id, text_channel_id, stream_url, stream_name, requester_id FROM guild_state WHERE bot_id = ?",
+            (bot_id,)).fetchall()
+        return {
+            str(guild_id): {'voice_channel_id': vc_id, 'text_channel_id': txt_id, 'stream_url': url, 'stream_name': name, 'requester_id': req_id}
+            for guild_id, vc_id, txt_id, url, name, req_id in rows
+        }
 
-    try:
-        with open(STATE_FILE, 'w') as f:
-            json.dump(persistent_state, f, indent=4)
-        logger.info(f"Successfully saved state for {len(persistent_state)} guild(s) to {STATE_FILE}")
-    except IOError as e:
-        logger.error(f"Error saving state to {STATE_FILE}: {e}")
-    except Exception as e:
-        logger.exception(f"Unexpected error saving state: {e}")
+    def write(self, changes: dict, snapshot: dict | None):
+        if self.bot_id is None:
+            raise RuntimeError("SqliteStateBackend.write() called before load()")
+        now = time.time()
+        upserts = [(self.bot_id, guild_id, r['voice_channel_id'], r['text_channel_id'], r['stream_url'], r['stream_name'], r['requester_id'], now)
+                   for guild_id, r in changes.items() if r is not None]
+        deletes = [(self.bot_id, guild_id) for guild_id, r in changes.items() if r is None]
+        with self._conn: # One transaction per flush
+            self._conn.executemany("""
+                INSERT INTO guild_state (bot_id, guild_id, voice_channel_id, text_channel_id, stream_url, stream_name, requester_id, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (bot_id, guild_id) DO UPDATE SET
+                    voice_channel_id = excluded.voice_channel_id, text_channel_id = excluded.text_channel_id,
+                    stream_url = excluded.stream_url, stream_name = excluded.stream_name,
+                    requester_id = excluded.requester_id, updated_at = excluded.updated_at""", upserts)
+            self._conn.executemany("DELETE FROM guild_state WHERE bot_id = ? AND guild_id = ?", deletes)
+
+def create_state_backend():
+    if STATE_BACKEND == 'sqlite':
+        return SqliteStateBackend(STATE_DB_FILE)
+    return JsonStateBackend(STATE_FILE)
+
+state_backend = create_state_backend()
+
+class StateWriter:
+    """Coalesces save requests and hands them to the state backend from a worker thread.
+
+    mark_dirty() is cheap and safe to call from any thread; changes arriving within
+    STATE_SAVE_DEBOUNCE seconds end up in a single write.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._dirty_guilds = set()
+        self._loop = None
+        self._timer = None
+        self._lock = asyncio.Lock() # One write in flight at a time
+
+    def mark_dirty(self, guild_id: int):
+        self._dirty_guilds.add(guild_id)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError: # Called from a player thread
+            if self._loop and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._schedule)
+            return
+        self._schedule()
+
+    def _schedule(self):
+        self._loop = asyncio.get_running_loop()
+        if self._timer is None:
+            self._timer = self._loop.call_later(STATE_SAVE_DEBOUNCE, self._start_flush)
+
+    def _start_flush(self):
+        self._timer = None
+        asyncio.create_task(self.flush())
+
+    async def flush(self):
+        """Writes pending changes now. Also called on shutdown."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            if not self._dirty_guilds: return
+            dirty_guilds, self._dirty_guilds = self._dirty_guilds, set()
+            # Snapshots are taken on the loop so they can't race with state changes
+            changes = {guild_id: persistent_record(guild_id) for guild_id in dirty_guilds}
+            snapshot = build_persistent_state() if self.backend.full_snapshot else None
+            try:
+                started = time.perf_counter()
+                await asyncio.to_thread(self.backend.write, changes, snapshot)
+                state_save_seconds.observe(time.perf_counter() - started, backend=STATE_BACKEND)
+                logger.info(f"Successfully saved state for {len(changes)} changed guild(s) to {self.backend.path}")
+            except (OSError, sqlite3.Error) as e:
+                logger.error(f"Error saving state to {self.backend.path}: {e}")
+                self._dirty_guilds |= dirty_guilds # Retry with the next change
+            except Exception as e:
+                logger.exception(f"Unexpected error saving state: {e}")
+                self._dirty_guilds |= dirty_guilds
+
+state_writer = StateWriter(state_backend)
+
+def save_state(guild_id: int):
+    """Marks a guild's state as changed; StateWriter persists it shortly after."""
+    state_writer.mark_dirty(guild_id)
 
 def load_state():
-    """Loads persistent state from state.json into guild_states."""
-    global guild_states
+    """Loads persistent state from the state backend into guild_states."""
+    guild_states.clear()
     try:
-        if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, 'r') as f:
-                loaded_data = json.load(f)
-                temp_states = {}
-                # Convert keys back to int, initialize runtime fields
-                for guild_id_str, saved_state in loaded_data.items():
-                    try:
-                        guild_id = int(guild_id_str)
-                        temp_states[guild_id] = {
-                            'vc': None, # VoiceClient needs to be re-established
-                            'url': saved_state.get('stream_url'),
-                            'stream_name': saved_state.get('stream_name'),
-                            'should_play': True, # Assume it should play if saved
-                            'retries': 0,
-                            'requester_id': saved_state.get('requester_id'),
-                            'text_channel_id': saved_state.get('text_channel_id'),
-                            'voice_channel_id': saved_state.get('voice_channel_id'),
-                            'now_playing_message_id': None, # Message needs to be resent
-                            'current_metadata': None,
-                            'is_resuming': True # Flag to indicate this state came from persistence
-                        }
-                        logger.info(f"[{guild_id}] Loaded saved state: VC={saved_state.get('voice_channel_id')}, URL={saved_state.get('stream_url')}")
-                    except (ValueError, KeyError, TypeError) as e:
-                        logger.error(f"Error processing saved state for guild '{guild_id_str}': {e} - Skipping.")
-                guild_states = temp_states
-                logger.info(f"Successfully loaded state for {len(guild_states)} guild(s) from {STATE_FILE}")
-        else:
-            logger.info(f"{STATE_FILE} not found, starting with empty state.")
-            guild_states = {}
-    except (IOError, json.JSONDecodeError) as e:
-        logger.error(f"Error loading state from {STATE_FILE}: {e}. Starting with empty state.")
-        guild_states = {}
+        loaded_data = state_backend.load(bot.user.id)
+        # Convert keys back to int, runtime fields (vc, message, metadata) start empty
+        for guild_id_str, saved_state in loaded_data.items():
+            try:
+                guild_id = int(guild_id_str)
+                state = guild_states.get_or_create(guild_id)
+                state.url = saved_state.get('stream_url')
+                state.stream_name = saved_state.get('stream_name')
+                state.requester_id = saved_state.get('requester_id')
+                state.text_channel_id = saved_state.get('text_channel_id')
+                state.voice_channel_id = saved_state.get('voice_channel_id')
+                state.should_play = True # Assume it should play if saved
+                state.is_resuming = True # Flag to indicate this state came from persistence
+                logger.info(f"[{guild_id}] Loaded saved state: VC={saved_state.get('voice_channel_id')}, URL={saved_state.get('stream_url')}")
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error(f"Error processing saved state for guild '{guild_id_str}': {e} - Skipping.")
+        logger.info(f"Successfully loaded state for {len(guild_states)} guild(s) from {state_backend.path}")
+    except (IOError, json.JSONDecodeError, sqlite3.Error) as e:
+        logger.error(f"Error loading state from {state_backend.path}: {e}. Starting with empty state.")
+        guild_states.clear()
     except Exception as e:
         logger.exception(f"Unexpected error loading state: {e}. Starting with empty state.")
-        guild_states = {}
+        guild_states.clear()
+
+# --- Stream Probe Cache ---
+# Remembers what each stream URL contains so later plays can skip FFmpeg's multi-second sniffing.
+
+def build_ffmpeg_input_options(probe_info: dict | None, piped: bool = False) -> str:
+    """Builds FFmpeg input options, using tight explicit ones when the stream has been probed before."""
+    # -reconnect options only exist for FFmpeg's HTTP input, piped streams reconnect in IcyStreamPipe
+    reconnect_options = '' if piped else FFMPEG_RECONNECT_OPTIONS
+    if not probe_info:
+        return f"{reconnect_options} -analyzeduration 5000000 -probesize 5000000".strip() # Unknown stream, let FFmpeg sniff it
+    options = [reconnect_options, '-analyzeduration 0', f"-probesize {PROBE_CACHE_PROBESIZE}"]
+    if probe_info.get('container'): options.append(f"-f {probe_info['container']}")
+    if probe_info.get('codec'): options.append(f"-c:a {probe_info['codec']}")
+    return ' '.join(option for option in options if option)
+
+class ProbeCache:
+    """Persistent per-URL cache of ffprobe results (container, codec, sample rate, channels, bitrate)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._entries: dict[str, dict] = {}
+        self._pending: dict[str, asyncio.Task] = {} # One ffprobe per URL even when many guilds start at once
+        self._dirty = False
+        self._save_task: asyncio.Task | None = None
+        self._lock = asyncio.Lock() # One write in flight at a time
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    self._entries = json.load(f)
+                logger.info(f"Loaded {len(self._entries)} cached stream probe(s) from {self.path}")
+        except (IOError, json.JSONDecodeError) as e:
+            logger.error(f"Error loading probe cache from {self.path}: {e}. Starting with empty cache.")
+            self._entries = {}
+
+    def _save(self):
+        """Schedules a write; saves requested while one is running are folded into the next."""
+        self._dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        """Writes the cache if it changed. Also called on shutdown."""
+        async with self._lock:
+            while self._dirty:
+                self._dirty = False
+                data = json.dumps(self._entries) # Snapshot on the loop, entries only change there
+                try:
+                    await asyncio.to_thread(write_file_atomic, self.path, data)
+                except OSError as e:
+                    logger.error(f"Error saving probe cache to {self.path}: {e}")
+
+    def get(self, stream_url: str) -> dict | None:
+        entry = self._entries.get(stream_url)
+        if entry and time.time() - entry.get('probed_at', 0) > PROBE_CACHE_TTL:
+            return None # Stale, stations do change encoders
+        return entry
+
+    def invalidate(self, stream_url: str):
+        if self._entries.pop(stream_url, None) is not None:
+            logger.info(f"Invalidated cached probe for {stream_url}.")
+            self._save()
+
+    async def get_or_probe(self, stream_url: str) -> dict | None:
+        """Returns cached probe info, running ffprobe on a miss."""
+        entry = self.get(stream_url)
+        if entry: return entry
+        task = self._pending.get(stream_url)
+        if task is None:
+            task = asyncio.create_task(self._probe(stream_url))
+            self._pending[stream_url] = task
+            task.add_done_callback(lambda _: self._pending.pop(stream_url, None))
+        return await asyncio.shield(task)
+
+    def probe_in_background(self, stream_url: str):
+        """Fills the cache for a later play without delaying the current one."""
+        if stream_url not in self._pending and not self.get(stream_url):
+            task = asyncio.create_task(self._probe(stream_url))
+            self._pending[stream_url] = task
+            task.add_done_callback(lambda _: self._pending.pop(stream_url, None))
+
+    async def _probe(self, stream_url: str) -> dict | None:
+        args = ['ffprobe', '-v', 'error', '-print_format', 'json', '-select_streams', 'a:0',
+                '-show_entries', 'format=format_name,bit_rate:stream=codec_name,sample_rate,channels,bit_rate', stream_url]
+        try:
+            process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            try:
+                output, _ = await asyncio.wait_for(process.communicate(), timeout=PROBE_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.kill()
+                logger.warning(f"Timed out probing {stream_url}.")
+                return None
+            data = json.loads(output or b'{}')
+            streams = data.get('streams') or [{}]
+            stream, container = streams[0], data.get('format', {})
+            if not stream.get('codec_name'):
+                logger.warning(f"Probe found no audio stream for {stream_url}.")
+                return None
+            entry = {
+                'container': (container.get('format_name') or '').split(',')[0] or None, # e.g. 'mov,mp4,m4a' -> 'mov'
+                'codec': stream['codec_name'],
+                'sample_rate': int(stream.get('sample_rate') or 0) or None,
+                'channels': stream.get('channels'),
+                'bitrate': int(stream.get('bit_rate') or container.get('bit_rate') or 0) or None,
+                'probed_at': time.time(),
+            }
+        except (OSError, ValueError) as e:
+            logger.warning(f"Error probing {stream_url}: {e}")
+            return None
+        self._entries[stream_url] = entry
+        self._save()
+        logger.info(f"Cached probe for {stream_url}: {entry['container']}/{entry['codec']} {entry['sample_rate']}Hz {entry['channels']}ch")
+        return entry
+
+probe_cache = ProbeCache(PROBE_CACHE_FILE)
+
+# --- ICY Metadata Parsing ---
+
+# Key='value'; pairs. Values may contain quotes and semicolons (e.g. "Guns N' Roses"), so a value only
+# ends at a closing quote followed by ';' and then another key (possibly cut short) or the end of the block.
+ICY_FIELD_PATTERN = re.compile(r"""(?<!\w)(\w+)=(?:'(.*?)'|"(.*?)"|([^;]*?))\s*(?:;|$)(?=\s*(?:\w+(?:=|$)|$))""", re.S)
+
+def parse_icy_metadata(raw: bytes | bytearray) -> dict[str, str]:
+    """Parses one ICY metadata block into its key/value pairs (StreamTitle, StreamUrl, ...)."""
+    raw = raw.rstrip(b'\0') # Blocks are NUL-padded to a multiple of 16 bytes
+    try:
+        text = raw.decode('utf-8')
+    except UnicodeDecodeError:
+        text = raw.decode('cp1252', errors='replace') # Older Shoutcast servers send Windows-1252
+    fields = {}
+    for match in ICY_FIELD_PATTERN.finditer(text):
+        key, single_quoted, double_quoted, bare = match.groups()
+        if single_quoted is not None: value = single_quoted
+        elif double_quoted is not None: value = double_quoted
+        else: value = bare.strip().strip('\'"') # Unquoted, or truncated before the closing quote
+        fields[key] = value.strip()
+    return fields
+
+class IcyMetadataParser:
+    """Incremental ICY stream parser, a state machine fed arbitrary chunks.
+
+    Returns one record (dict of key/value pairs) per non-empty metadata block. Audio bytes between
+    blocks are skipped without copying, or appended to audio_out when one is given. Memory use is
+    bounded by the largest possible metadata block (255 * 16 bytes), whatever icy-metaint is.
+    """
+
+    def __init__(self, metaint: int):
+        if metaint <= 0:
+            raise ValueError(f"Invalid icy-metaint: {metaint}")
+        self.metaint = metaint
+        self._audio_left = metaint # Audio bytes until the next metadata length byte
+        self._meta_left = None # Metadata bytes still to read, None while waiting for the length byte
+        self._meta_buffer = bytearray()
+
+    def feed(self, data: bytes, audio_out: bytearray | None = None) -> list[dict[str, str]]:
+        records = []
+        view = memoryview(data) # Slicing a memoryview doesn't copy
+        pos, size = 0, len(view)
+        while pos < size:
+            if self._audio_left:
+                skipped = min(self._audio_left, size - pos)
+                if audio_out is not None:
+                    audio_out += view[pos:pos + skipped]
+                pos += skipped
+                self._audio_left -= skipped
+            elif self._meta_left is None:
+                self._meta_left = view[pos] * 16
+                pos += 1
+                if not self._meta_left: # Empty block, nothing changed
+                    self._meta_left = None
+                    self._audio_left = self.metaint
+            else:
+                taken = min(self._meta_left, size - pos)
+                self._meta_buffer += view[pos:pos + taken]
+                pos += taken
+                self._meta_left -= taken
+                if not self._meta_left:
+                    record = parse_icy_metadata(self._meta_buffer)
+                    if record:
+                        records.append(record)
+                    self._meta_buffer.clear()
+                    self._meta_left = None
+                    self._audio_left = self.metaint
+        return records
+
+# --- Shared Stream Decoding ---
+# One decoder per unique stream, fanned out to every guild playing it.
+# Guild players receive lightweight HubSubscriber sources instead of their own FFmpeg process.
+
+class StreamHubError(Exception):
+    """Raised to a subscriber when its shared decoder stops delivering audio."""
+
+    def __init__(self, message: str, broadcast_id: int | None = None):
+        super().__init__(message)
+        self.broadcast_id = broadcast_id # Same for every guild hit by one decoder failing, so it counts once
+
+class UpstreamError(StreamHubError):
+    """The stream's HTTP upstream went away or stopped sending audio."""
+
+class DecoderError(StreamHubError):
+    """The FFmpeg decoder exited or failed while the upstream may still be fine."""
+
+class HubSubscriber(discord.AudioSource):
+    """AudioSource handed to a guild's voice client, fed by a shared StreamBroadcast."""
+
+    def __init__(self, hub: 'StreamHub', broadcast: 'StreamBroadcast'):
+        self._hub = hub
+        self._broadcast = broadcast
+        self._frames = collections.deque(maxlen=STREAM_HUB_BUFFER_FRAMES) # Oldest frames drop if the player falls behind
+        self._condition = threading.Condition()
+        self._ended = False
+        self._current_error = None # Why read() returned b''; handed to the after callback by PlayerEventBridge
+        self.on_first_frame = None # Called once, from the player thread, when the first frame is handed out
+
+    def _push(self, frame: bytes):
+        with self._condition:
+            self._frames.append(frame)
+            self._condition.notify()
+
+    def _end(self, error: Exception | None):
+        with self._condition:
+            self._ended = True
+            self._current_error = error
+            self._condition.notify()
+
+    def read(self) -> bytes:
+        with self._condition:
+            if not self._frames and not self._ended:
+                self._condition.wait_for(lambda: self._frames or self._ended, timeout=STREAM_HUB_READ_TIMEOUT)
+            if self._frames:
+                frame = self._frames.popleft()
+            else:
+                if not self._ended: # Timed out waiting for the decoder
+                    self._current_error = UpstreamError(f"No audio received for {STREAM_HUB_READ_TIMEOUT}s from {self._broadcast.stream_url}",
+                                                        self._broadcast.id)
+                return b''
+        if self.on_first_frame is not None: # The player sends this frame right away
+            callback, self.on_first_frame = self.on_first_frame, None
+            callback()
+        return frame
+
+    def is_opus(self) -> bool:
+        return self._broadcast.source.is_opus()
+
+    def cleanup(self):
+        self._hub.unsubscribe(self)
+
+class StreamBroadcast:
+    """Runs a single decoder for one stream and copies every frame to its subscribers."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, hub: 'StreamHub', key: tuple, stream_url: str, source: discord.AudioSource):
+        self.id = next(self._ids)
+        self.hub = hub
+        self.key = key # (engine, stream_url)
+        self.stream_url = stream_url
+        self.source = source
+        self.subscribers = () # Replaced (never mutated) under the hub lock so the decoder thread can iterate safely
+        self.stopped = False
+        self._thread = threading.Thread(target=self._run, name=f"stream-hub:{stream_url}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Stops the decoder. Called once the last subscriber has left."""
+        self.stopped = True
+        try: self.source.cleanup() # Kills FFmpeg, which also unblocks a pending read() in the decoder thread
+        except Exception as e: logger.debug(f"Error cleaning up decoder for {self.stream_url}: {e}")
+
+    def _run(self):
+        error = None
+        next_at = time.perf_counter()
+        try:
+            while not self.stopped:
+                frame = self.source.read()
+                if not frame:
+                    error = getattr(self.source, '_current_error', None)
+                    break
+                for subscriber in self.subscribers:
+                    subscriber._push(frame)
+                # Real-time pace, like discord.py's player: subscriber buffers are bounded, so decoding
+                # a file (or a burst) at full speed would drop all but the newest frames
+                next_at += STREAM_HUB_FRAME_SECONDS
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -STREAM_HUB_MAX_CATCHUP:
+                    next_at = time.perf_counter() # Upstream stalled, carry on from now
+        except Exception as e:
+            error = e
+        if self.stopped:
+            return # Stopped on purpose, no subscribers left to notify
+        failure = self._classify(error)
+        if failure is None:
+            logger.info(f"Shared decoder for {self.stream_url} reached the end of the stream.")
+        else:
+            logger.warning(f"Shared decoder for {self.stream_url} ended unexpectedly: {failure}")
+        self.hub._on_broadcast_ended(self, failure)
+
+    def _classify(self, error: Exception | None) -> StreamHubError | None:
+        """Tells an upstream failure (our pipe gave up) from the decoder failing. None for a clean end of stream."""
+        upstream = getattr(self.source, 'upstream', None)
+        if upstream is not None and upstream.failed:
+            return UpstreamError(f"Upstream {self.stream_url} lost after {ICY_PIPE_RECONNECT_ATTEMPTS} reconnects", self.id)
+        if error is not None:
+            return DecoderError(f"Decoder for {self.stream_url} failed: {error!r}", self.id)
+        try:
+            returncode = self.source._process.wait(timeout=STREAM_HUB_EXIT_TIMEOUT)
+        except (AttributeError, subprocess.TimeoutExpired):
+            returncode = None # Not an FFmpeg source, or it's still running: treat as a failure
+        if returncode == 0:
+            return None # A finite stream played to the end
+        return DecoderError(f"Decoder for {self.stream_url} exited (code {returncode})", self.id)
+
+class StreamHub:
+    """Reference-counts shared decoders per (engine, stream URL)."""
+
+    def __init__(self):
+        self._lock = threading.Lock() # Subscribers leave from discord.py's player threads
+        self._broadcasts: dict[tuple, StreamBroadcast] = {}
+
+    def is_running(self, stream_url: str, engine: str = 'pcm') -> bool:
+        with self._lock:
+            return (engine, stream_url) in self._broadcasts
+
+    def has_inline_metadata(self, stream_url: str) -> bool:
+        """True if a decoder for stream_url reads through IcyStreamPipe and so publishes titles itself."""
+        with self._lock:
+            return any(getattr(broadcast.source, 'upstream', None) is not None
+                       for (engine, url), broadcast in self._broadcasts.items() if url == stream_url)
+
+    def subscribe(self, stream_url: str, source_factory, engine: str = 'pcm') -> HubSubscriber:
+        """Returns a new subscriber for stream_url, starting a decoder via source_factory() if none is running."""
+        key = (engine, stream_url)
+        started = None
+        with self._lock:
+            broadcast = self._broadcasts.get(key)
+            if broadcast is None:
+                broadcast = StreamBroadcast(self, key, stream_url, source_factory())
+                self._broadcasts[key] = broadcast
+                started = broadcast
+            subscriber = HubSubscriber(self, broadcast)
+            broadcast.subscribers = broadcast.subscribers + (subscriber,)
+        if started:
+            started.start()
+            logger.info(f"Started shared {engine} decoder for {stream_url}")
+        else:
+            logger.info(f"Joined shared {engine} decoder for {stream_url} ({len(broadcast.subscribers)} subscriber(s))")
+        return subscriber
+
+    def unsubscribe(self, subscriber: HubSubscriber):
+        """Detaches a subscriber, stopping its decoder when it was the last one."""
+        broadcast = subscriber._broadcast
+        with self._lock:
+            if subscriber not in broadcast.subscribers: return # Already detached
+            broadcast.subscribers = tuple(s for s in broadcast.subscribers if s is not subscriber)
+            last = not broadcast.subscribers
+            if last and self._broadcasts.get(broadcast.key) is broadcast:
+                del self._broadcasts[broadcast.key]
+        subscriber._end(None)
+        if last:
+            logger.info(f"Last subscriber left, stopping shared decoder for {broadcast.stream_url}")
+            broadcast.stop()
+
+    def _on_broadcast_ended(self, broadcast: StreamBroadcast, error: Exception | None):
+        with self._lock:
+            if self._broadcasts.get(broadcast.key) is broadcast:
+                del self._broadcasts[broadcast.key]
+            subscribers, broadcast.subscribers = broadcast.subscribers, ()
+        for subscriber in subscribers:
+            subscriber._end(error) # Each guild's player ends and goes through after_playback_handler (error None: normal stop)
+        broadcast.stop()
+
+    def stats(self) -> dict:
+        with self._lock:
+            broadcasts = list(self._broadcasts.values())
+        return {
+            'streams': len(broadcasts),
+            'subscribers': sum(len(b.subscribers) for b in broadcasts),
+            'ffmpeg_processes': sum(1 for b in broadcasts if getattr(b.source, '_process', None) and b.source._process.poll() is None),
+        }
+
+stream_hub = StreamHub()
+
+# Streams FFmpeg has to open itself: their body isn't the audio (playlists, HLS)
+PLAYLIST_EXTENSIONS = ('.m3u8', '.m3u', '.pls', '.asx', '.xspf')
+PLAYLIST_CONTENT_TYPES = {'application/vnd.apple.mpegurl', 'application/x-mpegurl', 'audio/mpegurl', 'audio/x-mpegurl',
+                          'audio/x-scpls', 'application/pls+xml', 'video/x-ms-asf', 'application/xspf+xml'}
+
+class IcyStreamPipe:
+    """File-like upstream for FFmpeg's stdin.
+
+    Downloads the stream itself with Icy-Metadata enabled, strips metadata blocks inline and publishes
+    the titles, so each station is downloaded once for both audio and metadata. read() is called from
+    discord.py's stdin writer thread; network I/O still runs on the event loop. Only used for streams
+    that open() accepts; everything else goes straight to FFmpeg as before.
+    """
+
+    def __init__(self, stream_url: str):
+        self.stream_url = stream_url
+        self.closed = False
+        self._loop = asyncio.get_running_loop()
+        self._response = None
+        self._parser = None # None when the stream has no ICY metadata
+        self._reconnects = 0
+        self.failed = False # Set once reconnects are exhausted, so the decoder's exit is blamed on the upstream
+
+    def _run(self, coro):
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        try:
+            return future.result(timeout=ICY_PIPE_READ_TIMEOUT)
+        except BaseException:
+            future.cancel()
+            raise
+
+    async def _connect(self):
+        headers = {'Icy-Metadata': '1'}
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=ICY_PIPE_READ_TIMEOUT)
+        started = time.perf_counter()
+        response = await bot.http_session.get(self.stream_url, headers=headers, timeout=timeout)
+        metadata_fetch_seconds.observe(time.perf_counter() - started, source='pipe')
+        if not 200 <= response.status < 300:
+            metadata_errors.inc(source='pipe', error=f"http_{response.status}")
+            response.close()
+            raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status)
+        metaint_header = response.headers.get('icy-metaint')
+        self._parser = IcyMetadataParser(int(metaint_header)) if metaint_header else None
+        self._response = response
+
+    async def open(self) -> bool:
+        """Connects ahead of FFmpeg. False if the URL is better left to FFmpeg.
+
+        That is: playlists/HLS, streams without ICY metadata (including finite files, which a
+        reconnecting pipe would replay), and servers aiohttp can't talk to, e.g. SHOUTcast v1's
+        "ICY 200 OK" status line.
+        """
+        if urllib.parse.urlsplit(self.stream_url).path.lower().endswith(PLAYLIST_EXTENSIONS):
+            return False
+        try:
+            await self._connect()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.info(f"Can't read {self.stream_url} directly ({e}), letting FFmpeg open it.")
+            return False
+        if self._response.content_type in PLAYLIST_CONTENT_TYPES:
+            reason = f"playlist ({self._response.content_type})"
+        elif self._parser is None:
+            reason = "no icy-metaint"
+        else:
+            return True
+        logger.info(f"Stream {self.stream_url} has {reason}, letting FFmpeg open it.")
+        self.close()
+        return False
+
+    def _drop_response(self):
+        response, self._response = self._response, None
+        if response is not None:
+            try: self._loop.call_soon_threadsafe(response.close)
+            except RuntimeError: pass # Loop already closed during shutdown
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.closed:
+            try:
+                if self._response is None:
+                    self._run(self._connect())
+                chunk = self._run(self._response.content.read(ICY_PIPE_CHUNK_SIZE))
+            except Exception as e:
+                if not isinstance(e, aiohttp.ClientResponseError): # Already counted by _connect
+                    metadata_errors.inc(source='pipe', error=type(e).__name__)
+                logger.warning(f"Upstream read error for {self.stream_url}: {e!r}")
+                chunk = b''
+            if not chunk: # Upstream dropped, reconnect like FFmpeg's -reconnect would
+                self._drop_response()
+                if self.closed or self._reconnects >= ICY_PIPE_RECONNECT_ATTEMPTS:
+                    self.failed = not self.closed
+                    return b'' # EOF for FFmpeg, the shared decoder then reports the failure
+                self._reconnects += 1
+                logger.info(f"Reconnecting upstream {self.stream_url} ({self._reconnects}/{ICY_PIPE_RECONNECT_ATTEMPTS}).")
+                time.sleep(1)
+                continue
+            self._reconnects = 0
+            if self._parser is None:
+                return chunk
+            audio = bytearray()
+            for record in self._parser.feed(chunk, audio):
+                if 'StreamTitle' in record:
+                    self._loop.call_soon_threadsafe(update_stream_title, self.stream_url, record['StreamTitle'] or None)
+            if audio: # A chunk can be all metadata, never return b'' for that
+                return bytes(audio)
+        return b''
+
+    def close(self):
+        self.closed = True
+        self._drop_response()
+
+class IcyPipedPCMAudio(discord.FFmpegPCMAudio):
+    """FFmpegPCMAudio fed from an IcyStreamPipe, closing the upstream along with the process."""
+
+    def __init__(self, upstream: IcyStreamPipe, **kwargs):
+        self.upstream = upstream
+        super().__init__(upstream, pipe=True, **kwargs)
+
+    def cleanup(self):
+        super().cleanup()
+        self.upstream.close()
+
+class IcyPipedOpusAudio(discord.FFmpegOpusAudio):
+    """FFmpegOpusAudio fed from an IcyStreamPipe, closing the upstream along with the process."""
+
+    def __init__(self, upstream: IcyStreamPipe, **kwargs):
+        self.upstream = upstream
+        super().__init__(upstream, pipe=True, **kwargs)
+
+    def cleanup(self):
+        super().cleanup()
+        self.upstream.close()
+
+async def _open_upstream(stream_url: str, engine: str) -> IcyStreamPipe | None:
+    """Connects the inline-metadata upstream for a new decoder; None means FFmpeg opens the URL itself."""
+    if not ICY_INLINE_METADATA or stream_hub.is_running(stream_url, engine):
+        return None
+    upstream = IcyStreamPipe(stream_url)
+    return upstream if await upstream.open() else None
+
+def _subscribe(stream_url: str, factory, engine: str, upstream: IcyStreamPipe | None) -> HubSubscriber:
+    try:
+        subscriber = stream_hub.subscribe(stream_url, factory, engine=engine)
+    except BaseException:
+        if upstream is not None:
+            upstream.close() # e.g. FFmpeg missing: don't leak the already open connection
+        raise
+    if upstream is not None and getattr(subscriber._broadcast.source, 'upstream', None) is not upstream:
+        upstream.close() # Another guild started the decoder first, ours wasn't needed
+    return subscriber
+
+async def create_stream_source(stream_url: str, trace: 'PlaybackTrace | None' = None) -> HubSubscriber:
+    """Subscribes to the shared decoder for stream_url using the configured PLAYBACK_ENGINE."""
+    if PLAYBACK_ENGINE == 'opus':
+        probe_info = None
+        if not stream_hub.is_running(stream_url, engine='opus'): # No need to probe when joining a running decoder
+            probe_info = await probe_cache.get_or_probe(stream_url) # Codec decides passthrough vs. encode
+            if trace: trace.stage('probe')
+            codec = probe_info['codec'] if probe_info else None
+            mode = 'passthrough' if codec in ('opus', 'libopus') else 'FFmpeg encode'
+            logger.info(f"Stream {stream_url} has codec '{codec}', using Opus {mode}.")
+        upstream = await _open_upstream(stream_url, 'opus')
+        ffmpeg_options = {
+            'before_options': build_ffmpeg_input_options(probe_info, piped=upstream is not None),
+            'options': '-vn -loglevel warning', # Suppress verbose ffmpeg logs, show warnings/errors
+            'codec': probe_info and probe_info['codec'],
+            'bitrate': OPUS_BITRATE,
+        }
+        # Opus streams are copied packet-for-packet, anything else is encoded by FFmpeg so Python never handles PCM
+        if upstream is not None:
+            factory = lambda: IcyPipedOpusAudio(upstream, **ffmpeg_options)
+        else:
+            factory = lambda: discord.FFmpegOpusAudio(stream_url, **ffmpeg_options)
+        subscriber = _subscribe(stream_url, factory, 'opus', upstream)
+        if trace: trace.stage('decoder')
+        return subscriber
+
+    probe_info = probe_cache.get(stream_url)
+    if not probe_info:
+        probe_cache.probe_in_background(stream_url) # First play sniffs as before, later plays start fast
+    upstream = await _open_upstream(stream_url, 'pcm')
+    ffmpeg_options = {
+        'before_options': build_ffmpeg_input_options(probe_info, piped=upstream is not None),
+        'options': '-vn -loglevel warning' # Suppress verbose ffmpeg logs, show warnings/errors
+    }
+    if upstream is not None:
+        factory = lambda: IcyPipedPCMAudio(upstream, **ffmpeg_options)
+    else:
+        factory = lambda: discord.FFmpegPCMAudio(stream_url, **ffmpeg_options)
+    subscriber = _subscribe(stream_url, factory, 'pcm', upstream)
+    if trace: trace.stage('decoder')
+    return subscriber
+
+# --- Requester Cache ---
+
+class RequesterCache:
+    """Resolves requester IDs for the Now Playing embed without a REST call per render.
+
+    Checks discord.py's user/member caches first, then an LRU with TTL (which also remembers
+    users that don't exist), and only fetches over REST on a miss.
+    """
+
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.max_size, self.ttl, self.negative_ttl = max_size, ttl, negative_ttl
+        self._entries = collections.OrderedDict() # user_id -> (expires_at, user or None)
+        self._pending: dict[int, asyncio.Task] = {} # Concurrent misses for one user share a fetch
+
+    async def resolve(self, user_id: int, guild: discord.Guild | None = None) -> discord.abc.User | None:
+        user = bot.get_user(user_id) or (guild.get_member(user_id) if guild else None)
+        if user: return user
+        entry = self._entries.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            return entry[1]
+        task = self._pending.get(user_id)
+        if task is None:
+            task = self._pending[user_id] = asyncio.create_task(self._fetch(user_id))
+            task.add_done_callback(lambda _: self._pending.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, user_id: int) -> discord.abc.User | None:
+        try:
+            user, ttl = await bot.fetch_user(user_id), self.ttl
+        except discord.NotFound:
+            user, ttl = None, self.negative_ttl
+        except discord.HTTPException as e:
+            logger.warning(f"Failed to fetch requester {user_id}: {e}")
+            return None # Transient, don't cache
+        self._entries[user_id] = (time.monotonic() + ttl, user)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False) # Evict least recently used
+        return user
+
+requester_cache = RequesterCache(REQUESTER_CACHE_SIZE, REQUESTER_CACHE_TTL, REQUESTER_CACHE_NEGATIVE_TTL)
+
+# --- Now Playing Embed Rendering ---
+
+def build_now_playing_embed(state: GuildState, requester_mention: str) -> discord.Embed:
+    """Builds the 'Now Playing' embed for a guild's state."""
+    embed = discord.Embed(
+        title="▶️ Now Playing",
+        color=discord.Color.green(),
+        timestamp=datetime.datetime.now(datetime.timezone.utc)
+    )
+    stream_name = state.stream_name or 'Unknown Stream'
+    metadata = state.current_metadata
+
+    embed.add_field(name="Stream", value=f"`{stream_name}`", inline=False)
+    if metadata:
+        embed.add_field(name="Current Track", value=f"```{metadata}```", inline=False) # Use code block for better formatting
+    embed.add_field(name="Requested By", value=requester_mention, inline=False)
+    embed.add_field(name="Playback Position", value="🔵 **LIVE**", inline=False)
+    try: embed.set_footer(text=f"{bot.user.name} Radio", icon_url=bot.user.display_avatar.url)
+    except: embed.set_footer(text=f"{bot.user.name} Radio")
+    return embed
+
+class EmbedRenderCache:
+    """Builds each distinct Now Playing embed once and shares it between guilds on the same stream.
+
+    Entries are keyed by (stream, metadata, requester, bot identity) and stored without a timestamp;
+    each render returns a copy stamped with the current time. Each comes with a hash of its content,
+    so guilds can skip edits that wouldn't change anything.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict() # key -> (embed, content_hash)
+        self.hits = self.misses = 0
+
+    async def render(self, state: GuildState, guild: discord.Guild) -> tuple[discord.Embed, str]:
+        try: avatar_url = str(bot.user.display_avatar.url)
+        except: avatar_url = None
+        key = (state.url, state.stream_name or 'Unknown Stream', state.current_metadata,
+               state.requester_id, bot.user.id, bot.user.name, avatar_url)
+        entry = self._entries.get(key)
+        if entry:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        else:
+            self.misses += 1
+            requester_id = state.requester_id
+            requester = await requester_cache.resolve(requester_id, guild) if requester_id else None # Cached, REST only on a miss
+            embed = build_now_playing_embed(state, requester.mention if requester else "Unknown")
+            embed.timestamp = None # Set per send below, a shared entry would keep showing when it was first built
+            content_hash = hashlib.sha1(json.dumps(embed.to_dict(), sort_keys=True).encode()).hexdigest()
+            entry = (embed, content_hash)
+            if requester or not requester_id: # Don't pin "Unknown" if the lookup only failed for now
+                self._entries[key] = entry
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        embed, content_hash = entry
+        embed = embed.copy()
+        embed.timestamp = datetime.datetime.now(datetime.timezone.utc)
+        return embed, content_hash
+
+embed_render_cache = EmbedRenderCache(EMBED_RENDER_CACHE_SIZE)
 
 # --- Helper Functions ---
 
+def process_rss_bytes() -> int | None:
+    """Current resident set size of this process (Linux), None where unavailable."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def memory_report() -> str:
+    """One-line RSS summary, normalised per 1,000 guilds so runtime profiles can be compared."""
+    rss = process_rss_bytes()
+    if rss is None: return f"RSS unavailable (profile={RUNTIME_PROFILE})"
+    guild_count = len(bot.guilds)
+    per_thousand = rss / guild_count * 1000 / 2**20 if guild_count else 0
+    return f"RSS {rss / 2**20:.1f} MiB for {guild_count} guild(s), {per_thousand:.1f} MiB per 1,000 guilds (profile={RUNTIME_PROFILE})"
+
+def set_now_playing_message(guild_id: int, message_id: int | None):
+    """Records (or clears) a guild's Now Playing message."""
+    state = guild_states[guild_id]
+    state.now_playing_message_id = message_id # Also updates the registry's message index
+    state.now_playing_message = None # Handle is rebuilt lazily for the new ID
+    state.now_playing_hash = None
+
+def now_playing_message_handle(guild_id: int) -> discord.PartialMessage | None:
+    """Returns a PartialMessage for the guild's Now Playing message; editing or deleting it needs no fetch."""
+    state = guild_states.get(guild_id)
+    if not state: return None
+    message_id, channel_id = state.now_playing_message_id, state.text_channel_id
+    if not message_id or not channel_id: return None
+    handle = state.now_playing_message
+    if handle is None or handle.id != message_id or handle.channel.id != channel_id:
+        handle = bot.get_partial_messageable(channel_id, guild_id=guild_id).get_partial_message(message_id)
+        state.now_playing_message = handle
+    return handle
+
 async def cleanup_now_playing_message(guild_id: int):
     """Safely deletes the existing 'Now Playing' message."""
     state = guild_states.get(guild_id)
     if not state: return # No state for guild
 
-    message_id = state.get('now_playing_message_id')
-    channel_id = state.get('text_channel_id')
-    state['now_playing_message_id'] = None # Clear ID immediately
+    message = now_playing_message_handle(guild_id)
+    message_id = state.now_playing_message_id
+    set_now_playing_message(guild_id, None) # Clear ID immediately
 
-    if message_id and channel_id:
+    if message:
         try:
-            guild = bot.get_guild(guild_id)
-            if not guild: return
-            channel = guild.get_channel(channel_id)
-            if not channel or not isinstance(channel, discord.TextChannel): return
-
-            message = await channel.fetch_message(message_id)
-            await message.delete()
+            await message.delete() # Deleted straight from the handle, no fetch needed
+            embed_rest_calls.inc(call='delete', outcome='ok')
             logger.info(f"[{guild_id}] Deleted previous 'Now Playing' message (ID: {message_id}).")
         except discord.NotFound:
+            embed_rest_calls.inc(call='delete', outcome='not_found')
             logger.debug(f"[{guild_id}] Previous 'Now Playing' message {message_id} not found (already deleted?).")
         except discord.Forbidden:
+            embed_rest_calls.inc(call='delete', outcome='forbidden')
             logger.warning(f"[{guild_id}] Missing permissions to delete 'Now Playing' message {message_id}.")
         except Exception as e:
+            embed_rest_calls.inc(call='delete', outcome='error')
             logger.error(f"[{guild_id}] Error deleting 'Now Playing' message {message_id}: {e}", exc_info=True)
 
 async def send_or_edit_now_playing_embed(guild_id: int, force_new: bool = False):
     """Creates/sends or edits the 'Now Playing' embed."""
     state = guild_states.get(guild_id)
-    if not state or not state.get('should_play'):
+    if not state or not state.should_play:
         logger.debug(f"[{guild_id}] send_or_edit_now_playing called but should_play is false.")
         await cleanup_now_playing_message(guild_id) # Ensure cleanup if state changed rapidly
         return
 
     guild = bot.get_guild(guild_id)
-    channel_id = state.get('text_channel_id')
+    channel_id = state.text_channel_id
     if not guild or not channel_id:
         logger.error(f"[{guild_id}] Cannot send/edit embed: Guild or text_channel_id missing."); return
 
@@ -163,44 +1334,35 @@ async def send_or_edit_now_playing_embed(guild_id: int, force_new: bool = False)
         logger.warning(f"[{guild_id}] Cannot send/edit embed: Channel {channel_id} not found or not text."); return
 
     # --- Create Embed Content ---
-    embed = discord.Embed(
-        title="▶️ Now Playing",
-        color=discord.Color.green(),
-        timestamp=datetime.datetime.now(datetime.timezone.utc)
-    )
-    stream_name = state.get('stream_name', 'Unknown Stream')
-    requester_id = state.get('requester_id')
-    requester = await bot.fetch_user(requester_id) if requester_id else None # Fetch user object
-    requester_mention = requester.mention if requester else "Unknown"
-    metadata = state.get('current_metadata')
-
-    embed.add_field(name="Stream", value=f"`{stream_name}`", inline=False)
-    if metadata:
-        embed.add_field(name="Current Track", value=f"```{metadata}```", inline=False) # Use code block for better formatting
-    embed.add_field(name="Requested By", value=requester_mention, inline=False)
-    embed.add_field(name="Playback Position", value="🔵 **LIVE**", inline=False)
-    try: embed.set_footer(text=f"{bot.user.name} Radio", icon_url=bot.user.display_avatar.url)
-    except: embed.set_footer(text=f"{bot.user.name} Radio")
+    embed, content_hash = await embed_render_cache.render(state, guild) # Shared by every guild showing the same thing
 
     # --- Send or Edit Logic ---
-    message_id = state.get('now_playing_message_id')
-    message = None
+    message_id = state.now_playing_message_id
+
+    # Nothing to do if the message already shows exactly this content (e.g. after a reconnect)
+    if not force_new and message_id and state.now_playing_hash == content_hash:
+        logger.debug(f"[{guild_id}] Now Playing embed unchanged, skipping edit.")
+        return
 
     # Try editing if not forced new and message ID exists
     if not force_new and message_id:
         try:
-            message = await channel.fetch_message(message_id)
-            await message.edit(embed=embed)
+            await now_playing_message_handle(guild_id).edit(embed=embed) # Single REST call, no fetch first
+            embed_rest_calls.inc(call='edit', outcome='ok')
+            state.now_playing_hash = content_hash
             logger.debug(f"[{guild_id}] Edited 'Now Playing' embed (ID: {message_id}).")
             return # Success editing
         except discord.NotFound:
+            embed_rest_calls.inc(call='edit', outcome='not_found')
             logger.info(f"[{guild_id}] Now Playing message {message_id} not found for editing, sending new one.")
             message_id = None # Force sending new below
-            state['now_playing_message_id'] = None
+            set_now_playing_message(guild_id, None)
         except discord.Forbidden:
+            embed_rest_calls.inc(call='edit', outcome='forbidden')
             logger.warning(f"[{guild_id}] Missing permissions to edit Now Playing message {message_id}.")
             # Can't edit, try sending new if needed
         except Exception as e:
+            embed_rest_calls.inc(call='edit', outcome='error')
             logger.error(f"[{guild_id}] Error editing Now Playing message {message_id}: {e}")
             # Can't edit, try sending new
 
@@ -209,70 +1371,406 @@ async def send_or_edit_now_playing_embed(guild_id: int, force_new: bool = False)
         await cleanup_now_playing_message(guild_id) # Clean up any potential lingering old message
         try:
             new_message = await channel.send(embed=embed)
-            state['now_playing_message_id'] = new_message.id
+            embed_rest_calls.inc(call='send', outcome='ok')
+            set_now_playing_message(guild_id, new_message.id)
+            state.now_playing_hash = content_hash
             logger.info(f"[{guild_id}] Sent new 'Now Playing' embed (ID: {new_message.id})")
             try:
                 await new_message.add_reaction(STOP_REACTION)
             except Exception as react_error:
                 logger.warning(f"[{guild_id}] Failed to add reaction to new message {new_message.id}: {react_error}")
         except discord.Forbidden:
+            embed_rest_calls.inc(call='send', outcome='forbidden')
             logger.warning(f"[{guild_id}] Missing permissions to send embed or add reactions in channel {channel.id}.")
-            state['now_playing_message_id'] = None # Ensure cleared on failure
+            set_now_playing_message(guild_id, None) # Ensure cleared on failure
         except Exception as e:
+            embed_rest_calls.inc(call='send', outcome='error')
             logger.error(f"[{guild_id}] Error sending new 'Now Playing' embed: {e}", exc_info=True)
-            state['now_playing_message_id'] = None
+            set_now_playing_message(guild_id, None)
+
+# --- Embed Update Scheduling ---
+# Now Playing renders are queued instead of awaited inline: one pending slot per guild (latest state wins),
+# per-channel token buckets, and user-triggered renders served before background metadata refreshes.
+
+EMBED_PRIORITY_USER = 0
+EMBED_PRIORITY_BACKGROUND = 1
+
+class TokenBucket:
+    """Classic token bucket; take() returns how long to wait before a token is available."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+class EmbedUpdateScheduler:
+    """Coalesces and rate-limits Now Playing embed renders."""
+
+    def __init__(self):
+        self._pending: dict[int, dict] = {} # guild_id -> {'force_new', 'priority', 'future'}
+        self._queue = asyncio.PriorityQueue() # (priority, seq, guild_id); stale entries are skipped
+        self._sequence = 0
+        self._rendering: set[int] = set()
+        self._buckets: dict[int, TokenBucket] = {} # Per text channel
+        self._workers = []
+        self.coalesced = self.rate_limited = self.rendered = self.failed = 0
+
+    def request(self, guild_id: int, force_new: bool = False, priority: int = EMBED_PRIORITY_BACKGROUND) -> asyncio.Future:
+        """Queues a render for guild_id. The returned future resolves once it has been rendered."""
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(EMBED_UPDATE_WORKERS)]
+        pending = self._pending.get(guild_id)
+        if pending:
+            self.coalesced += 1 # Folded into the render already waiting, which reads the latest state
+            pending['force_new'] |= force_new
+            if priority < pending['priority']:
+                pending['priority'] = priority
+                self._enqueue(guild_id, priority) # Jump the queue, the old entry becomes stale
+            return pending['future']
+        future = asyncio.get_running_loop().create_future()
+        self._pending[guild_id] = {'force_new': force_new, 'priority': priority, 'future': future}
+        self._enqueue(guild_id, priority)
+        return future
+
+    def _enqueue(self, guild_id: int, priority: int):
+        self._sequence += 1
+        self._queue.put_nowait((priority, self._sequence, guild_id))
+
+    def _bucket(self, channel_id: int) -> TokenBucket:
+        bucket = self._buckets.get(channel_id)
+        if bucket is None:
+            if len(self._buckets) > EMBED_BUCKET_LIMIT: # Forget idle channels
+                self._buckets = {cid: b for cid, b in self._buckets.items() if not b.is_full()}
+            bucket = self._buckets[channel_id] = TokenBucket(EMBED_EDITS_PER_SECOND, EMBED_EDIT_BURST)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            priority, _, guild_id = await self._queue.get()
+            pending = self._pending.get(guild_id)
+            if pending is None or pending['priority'] != priority:
+                continue # Already rendered, or re-queued with a higher priority
+            if guild_id in self._rendering: # Another worker is on it, come back once it's done
+                asyncio.get_running_loop().call_later(0.1, self._enqueue, guild_id, priority)
+                continue
+            state = guild_states.get(guild_id)
+            channel_id = state.text_channel_id if state else None
+            wait = self._bucket(channel_id).take() if channel_id else 0.0
+            if wait > 0:
+                self.rate_limited += 1
+                asyncio.get_running_loop().call_later(wait, self._enqueue, guild_id, priority)
+                continue
+            del self._pending[guild_id] # Later requests start a new slot
+            self._rendering.add(guild_id)
+            try:
+                await send_or_edit_now_playing_embed(guild_id, force_new=pending['force_new'])
+                self.rendered += 1
+            except Exception as e:
+                self.failed += 1
+                logger.exception(f"[{guild_id}] Unexpected error rendering Now Playing embed: {e}")
+            finally:
+                self._rendering.discard(guild_id)
+                if not pending['future'].done():
+                    pending['future'].set_result(None)
+
+    def stats(self) -> dict:
+        return {'queue_depth': len(self._pending), 'coalesced': self.coalesced, 'rate_limited': self.rate_limited,
+                'rendered': self.rendered, 'failed': self.failed}
+
+embed_updates = EmbedUpdateScheduler()
+
+# --- Retry Policy ---
+# Reconnect delays grow exponentially with jitter so guilds don't retry in lockstep. Failures are also
+# counted per stream URL across guilds: once a station looks down its circuit opens, a single probe
+# checks the upstream now and then, and every waiting guild is released together when it answers.
+
+def reconnect_backoff(attempt: int) -> float:
+    """Delay before reconnect attempt number `attempt` (1-based): exponential, with equal jitter."""
+    delay = min(RECONNECT_DELAY_MAX, RECONNECT_DELAY * 2 ** max(attempt - 1, 0))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class StreamCircuit:
+    """Circuit breaker state of one stream URL."""
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, stream_url: str):
+        self.stream_url = stream_url
+        self.state = self.CLOSED
+        self.failures = 0 # Consecutive failures while closed
+        self.last_incident: int | None = None # broadcast_id of the last shared decoder failure counted
+        self.open_for = STREAM_CIRCUIT_OPEN_MIN
+        self.closed = asyncio.Event() # Set while closed, waiters are released together when it closes again
+        self.closed.set()
+        self.probe_task: asyncio.Task | None = None
+
+class StreamCircuitBreaker:
+    """Per-stream-URL circuit breakers shared by all guilds."""
+
+    def __init__(self):
+        self._circuits: dict[str, StreamCircuit] = {}
+        self.opened = 0
+        self.probes = 0
+
+    def is_open(self, stream_url: str) -> bool:
+        circuit = self._circuits.get(stream_url)
+        return circuit is not None and circuit.state != StreamCircuit.CLOSED
+
+    def record_success(self, stream_url: str):
+        """Playback of stream_url started: reset its failure count and close its circuit."""
+        circuit = self._circuits.pop(stream_url, None) # Healthy streams don't need an entry
+        if circuit and circuit.state != StreamCircuit.CLOSED:
+            logger.info(f"Stream circuit for {stream_url} closed (playback started).")
+            self._close(circuit)
+
+    def record_failure(self, stream_url: str, incident: int | None = None):
+        """Playback of stream_url failed, opening its circuit once failures reach the threshold.
+
+        incident identifies a shared decoder failure: every guild on that decoder reports it, but it
+        counts as a single failure.
+        """
+        circuit = self._circuits.get(stream_url)
+        if circuit is None:
+            circuit = self._circuits[stream_url] = StreamCircuit(stream_url)
+        if circuit.state != StreamCircuit.CLOSED:
+            return # Already open, the probe decides when to retry
+        if incident is not None:
+            if incident == circuit.last_incident:
+                return
+            circuit.last_incident = incident
+        circuit.failures += 1
+        if circuit.failures >= STREAM_CIRCUIT_FAILURE_THRESHOLD:
+            self.opened += 1
+            circuit.state = StreamCircuit.OPEN
+            circuit.closed.clear()
+            circuit.probe_task = asyncio.create_task(self._probe_until_closed(circuit))
+            logger.warning(f"Stream circuit for {stream_url} opened after {circuit.failures} consecutive failures.")
+
+    async def wait_until_closed(self, stream_url: str, timeout: float) -> bool:
+        """Waits while stream_url's circuit is open. Returns False if it didn't close within timeout."""
+        circuit = self._circuits.get(stream_url)
+        if circuit is None or circuit.state == StreamCircuit.CLOSED:
+            return True
+        try:
+            await asyncio.wait_for(circuit.closed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _close(self, circuit: StreamCircuit):
+        circuit.state = StreamCircuit.CLOSED
+        circuit.failures = 0
+        circuit.open_for = STREAM_CIRCUIT_OPEN_MIN
+        if circuit.probe_task and circuit.probe_task is not asyncio.current_task():
+            circuit.probe_task.cancel()
+        circuit.probe_task = None
+        circuit.closed.set() # Releases every waiting guild at once
+
+    async def _probe_until_closed(self, circuit: StreamCircuit):
+        """While the circuit is open: wait, then probe the upstream once (half-open), doubling the wait on failure."""
+        while circuit.state != StreamCircuit.CLOSED:
+            await asyncio.sleep(circuit.open_for / 2 + random.uniform(0, circuit.open_for / 2))
+            circuit.state = StreamCircuit.HALF_OPEN
+            self.probes += 1
+            if await self._probe(circuit.stream_url):
+                logger.info(f"Stream circuit for {circuit.stream_url} closed (probe succeeded), releasing waiting guilds.")
+                if self._circuits.get(circuit.stream_url) is circuit:
+                    del self._circuits[circuit.stream_url] # Waiters retry with a fresh failure count
+                self._close(circuit)
+                return
+            circuit.state = StreamCircuit.OPEN
+            circuit.open_for = min(circuit.open_for * 2, STREAM_CIRCUIT_OPEN_MAX)
+            logger.info(f"Stream circuit probe for {circuit.stream_url} failed, next probe in ~{circuit.open_for}s.")
+
+    async def _probe(self, stream_url: str) -> bool:
+        """Opens the stream and reads its first bytes."""
+        if not bot.http_session or bot.http_session.closed:
+            return False
+        timeout = aiohttp.ClientTimeout(total=STREAM_CIRCUIT_PROBE_TIMEOUT)
+        try:
+            async with bot.http_session.get(stream_url, timeout=timeout) as response:
+                if response.status >= 400:
+                    return False
+                return bool(await response.content.read(1024))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.debug(f"Stream circuit probe for {stream_url} failed: {e}")
+            return False
+
+    def stop_all(self):
+        for circuit in self._circuits.values():
+            if circuit.probe_task:
+                circuit.probe_task.cancel()
+
+    def stats(self) -> dict:
+        return {'open': sum(1 for circuit in self._circuits.values() if circuit.state != StreamCircuit.CLOSED),
+                'opened': self.opened, 'probes': self.probes}
+
+stream_circuits = StreamCircuitBreaker()
+
+# --- Time-to-First-Audio Tracing ---
+# Each play, reconnect, resume or source restart carries a PlaybackTrace from the moment it's requested
+# until the player hands out the first audio frame. Stages are contiguous spans: queue (waiting for the
+# guild's actor), connect, stop_previous, probe, decoder (spawn or join FFmpeg), player_start, first_audio.
+
+TRIGGER_MANUAL, TRIGGER_RECONNECT, TRIGGER_RESUME, TRIGGER_RESTART = 'manual', 'reconnect', 'resume', 'restart'
+TTFA_STAGES = ('queue', 'connect', 'stop_previous', 'probe', 'decoder', 'player_start', 'first_audio')
+
+class PlaybackTrace:
+    __slots__ = ('guild_id', 'stream_url', 'trigger', 'started', 'spans', '_mark', '_loop')
+
+    def __init__(self, guild_id: int, stream_url: str, trigger: str):
+        self.guild_id, self.stream_url, self.trigger = guild_id, stream_url, trigger
+        self.started = self._mark = time.perf_counter()
+        self.spans: list[tuple[str, float, float]] = [] # (stage, offset from start, duration)
+        self._loop = asyncio.get_running_loop()
+
+    def stage(self, name: str, now: float | None = None):
+        """Closes the stage that ran since the previous one (or the start)."""
+        now = now or time.perf_counter()
+        self.spans.append((name, self._mark - self.started, now - self._mark))
+        self._mark = now
+
+    def slowest_stage(self) -> tuple[str, float]:
+        stage, _, duration = max(self.spans, key=lambda span: span[2], default=('n/a', 0.0, 0.0))
+        return stage, duration
+
+    def first_audio(self):
+        """Called from the player thread with the first frame."""
+        at = time.perf_counter()
+        try: self._loop.call_soon_threadsafe(ttfa_tracer.finish, self, at)
+        except RuntimeError: pass # Loop closed during shutdown
+
+class TtfaTracer:
+    """Aggregates completed traces into recent percentiles per trigger and stage."""
+
+    def __init__(self):
+        self._totals: dict[str, collections.deque] = {}
+        self._stages: dict[tuple[str, str], collections.deque] = {}
+        self.recent = collections.deque(maxlen=20) # (wall time, total seconds, trace) of completed traces, most recent last
+
+    def start(self, guild_id: int, stream_url: str, trigger: str) -> PlaybackTrace:
+        return PlaybackTrace(guild_id, stream_url, trigger)
+
+    def finish(self, trace: PlaybackTrace, at: float):
+        trace.stage('first_audio', at)
+        total = at - trace.started
+        self._totals.setdefault(trace.trigger, collections.deque(maxlen=TTFA_HISTORY)).append(total)
+        ttfa_seconds.observe(total, trigger=trace.trigger)
+        for stage, _, duration in trace.spans:
+            self._stages.setdefault((trace.trigger, stage), collections.deque(maxlen=TTFA_HISTORY)).append(duration)
+            ttfa_stage_seconds.observe(duration, trigger=trace.trigger, stage=stage)
+        self.recent.append((time.time(), total, trace))
+        breakdown = ', '.join(f"{stage} {duration * 1000:.0f}ms" for stage, _, duration in trace.spans)
+        logger.info(f"[{trace.guild_id}] Time to first audio {total:.2f}s ({trace.trigger}, {trace.stream_url}): {breakdown}")
+
+    def percentiles(self) -> dict:
+        """{trigger: {'count', 'p50', 'p90', 'p99', 'stages': {stage: p50}}} over recent traces."""
+        report = {}
+        for trigger, totals in self._totals.items():
+            values = sorted(totals)
+            report[trigger] = {
+                'count': len(values), 'p50': percentile(values, 0.5), 'p90': percentile(values, 0.9), 'p99': percentile(values, 0.99),
+                'stages': {stage: percentile(sorted(self._stages[(trigger, stage)]), 0.5)
+                           for stage in TTFA_STAGES if (trigger, stage) in self._stages},
+            }
+        return report
+
+ttfa_tracer = TtfaTracer()
 
-async def _play_internal(guild_id: int, voice_client: discord.VoiceClient):
-    """Internal logic to start FFmpeg playback."""
+async def _play_internal(guild_id: int, voice_client: discord.VoiceClient, restart: bool = False, trace: PlaybackTrace | None = None):
+    """Internal logic to start FFmpeg playback. restart=True respawns a failed source and keeps the Now Playing message."""
     state = guild_states.get(guild_id)
-    if not state or not state['should_play']:
+    if not state or not state.should_play:
         logger.warning(f"[{guild_id}] _play_internal called but should_play is false or state missing.")
         return
 
-    stream_url = state.get('url')
-    stream_name = state.get('stream_name', 'Unknown Stream')
+    stream_url = state.url
+    stream_name = state.stream_name or 'Unknown Stream'
     if not stream_url:
         logger.error(f"[{guild_id}] _play_internal called but stream_url is missing.")
-        state['should_play'] = False
-        save_state()
+        state.should_play = False
+        save_state(guild_id)
         return
 
     try:
         if voice_client.is_playing() or voice_client.is_paused():
             logger.info(f"[{guild_id}] Stopping existing playback before starting new stream '{stream_name}'.")
+            state.playback_started_at = None # The stopped playback's end event is stale now
             voice_client.stop()
             await asyncio.sleep(0.5) # Short delay
+            if trace: trace.stage('stop_previous')
 
-        ffmpeg_options = {
-            'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -analyzeduration 5000000 -probesize 5000000', # Added probe/analyze duration
-            'options': '-vn -loglevel warning' # Suppress verbose ffmpeg logs, show warnings/errors
-        }
-        audio_source = discord.FFmpegPCMAudio(stream_url, **ffmpeg_options)
+        # Guilds on the same stream share one FFmpeg process via the hub
+        audio_source = await create_stream_source(stream_url, trace)
+        if trace and trace.stream_url == stream_url:
+            audio_source.on_first_frame = trace.first_audio
 
-        after_callback = functools.partial(after_playback_handler, guild_id)
-        voice_client.play(audio_source, after=after_callback)
+        started_at = time.monotonic() # Identifies this playback in its end event
+        after_callback = player_events.after_callback(guild_id, started_at, audio_source)
+        try:
+            voice_client.play(audio_source, after=after_callback)
+        except Exception:
+            audio_source.cleanup() # Release the hub subscription if the player never took it
+            raise
+        if trace: trace.stage('player_start')
 
         logger.info(f"[{guild_id}] Playback started via FFmpeg for stream: {stream_name} ({stream_url})")
-        state['retries'] = 0 # Reset retries on successful play start
-        state['is_resuming'] = False # No longer resuming once playback starts
-        save_state() # Save state after successful start
+        state.playback_started_at = started_at
+        asyncio.get_running_loop().call_later(PLAYBACK_STABLE_AFTER, mark_playback_stable, guild_id, started_at)
+        embed_priority = EMBED_PRIORITY_BACKGROUND if state.is_resuming else EMBED_PRIORITY_USER
+        state.is_resuming = False # No longer resuming once playback starts
+        save_state(guild_id) # Save state after successful start
+
+        if not stream_hub.has_inline_metadata(stream_url): # FFmpeg opened the URL itself, titles need their own reader
+            icy_readers.ensure(stream_url)
+        state.current_metadata = stream_titles.get(stream_url) # Reuse the title if another guild already has this stream
 
         # Send embed after starting
-        await send_or_edit_now_playing_embed(guild_id, force_new=True) # Force new on initial play/resume
+        if restart:
+            embed_updates.request(guild_id, priority=EMBED_PRIORITY_BACKGROUND) # Same stream, edit the existing embed
+        else:
+            embed_updates.request(guild_id, force_new=True, priority=embed_priority) # Force new on initial play/resume
 
     except discord.errors.ClientException as e:
         logger.error(f"[{guild_id}] discord.py ClientException during play setup for '{stream_name}': {e}")
-        state['should_play'] = False
-        save_state()
+        state.should_play = False
+        save_state(guild_id)
         # Optionally notify text channel
     except Exception as e:
         logger.error(f"[{guild_id}] Error starting FFmpeg playback for '{stream_name}': {e}", exc_info=True)
-        state['should_play'] = False
-        save_state()
+        state.should_play = False
+        save_state(guild_id)
         # Optionally notify text channel
 
-async def ensure_voice_and_play(guild_id: int, voice_channel_id: int, text_channel_id: int | None, stream_url: str, stream_name: str, requester_id: int | None, is_manual_play: bool = False):
+def mark_playback_stable(guild_id: int, started_at: float):
+    """Called PLAYBACK_STABLE_AFTER seconds into a playback: if it's still running, reset retries and report the stream healthy."""
+    state = guild_states.get(guild_id)
+    if not state or not state.should_play or state.playback_started_at != started_at:
+        return # Stopped or restarted since
+    if state.vc and state.vc.is_playing():
+        state.retries = 0
+        stream_circuits.record_success(state.url)
+
+async def ensure_voice_and_play(guild_id: int, voice_channel_id: int, text_channel_id: int | None, stream_url: str, stream_name: str, requester_id: int | None, is_manual_play: bool = False,
+                                trace: PlaybackTrace | None = None):
     """Connects/moves to VC and initiates playback. Handles state updates."""
+    if trace: trace.stage('queue')
     guild = bot.get_guild(guild_id)
     if not guild:
         logger.error(f"[{guild_id}] ensure_voice_and_play: Guild not found.")
@@ -284,20 +1782,18 @@ async def ensure_voice_and_play(guild_id: int, voice_channel_id: int, text_chann
         return f"Error: Voice channel not found."
 
     # Update state *before* attempting connection/play
-    if guild_id not in guild_states: guild_states[guild_id] = {}
-    guild_states[guild_id].update({
-        'url': stream_url,
-        'stream_name': stream_name,
-        'requester_id': requester_id,
-        'text_channel_id': text_channel_id,
-        'voice_channel_id': voice_channel_id,
-        'should_play': True,
-        'retries': guild_states[guild_id].get('retries', 0), # Keep existing retries during reconnect attempts
-        'vc': guild.voice_client, # Get current VC, might be None
-        'now_playing_message_id': guild_states[guild_id].get('now_playing_message_id'), # Keep existing message ID if reconnecting
-        'current_metadata': None, # Reset metadata on new play/reconnect
-        'is_resuming': not is_manual_play, # Mark as resuming if not triggered by a user play command
-    })
+    # Retries and the Now Playing message are kept as-is during reconnect attempts
+    state = guild_states.get_or_create(guild_id)
+    if is_manual_play: state.retries = 0
+    state.url = stream_url
+    state.stream_name = stream_name
+    state.requester_id = requester_id
+    state.text_channel_id = text_channel_id
+    state.voice_channel_id = voice_channel_id
+    state.should_play = True
+    state.vc = guild.voice_client # Get current VC, might be None
+    state.current_metadata = None # Reset metadata on new play/reconnect
+    state.is_resuming = not is_manual_play # Mark as resuming if not triggered by a user play command
     logger.info(f"[{guild_id}] Updating state: should_play=True, VC ID={voice_channel_id}, URL={stream_url}")
 
     voice_client = guild.voice_client # Get current VC
@@ -312,186 +1808,874 @@ async def ensure_voice_and_play(guild_id: int, voice_channel_id: int, text_chann
         else:
             logger.info(f"[{guild_id}] Connecting to voice channel: {voice_channel.name}")
             voice_client = await voice_channel.connect(timeout=60.0, reconnect=True)
-            guild_states[guild_id]['vc'] = voice_client # Store the new VC object
+            state.vc = voice_client # Store the new VC object
 
         # Ensure VC object is stored correctly
         if not voice_client or not voice_client.is_connected():
             raise Exception("Failed to connect or store voice client.")
+        if trace: trace.stage('connect')
 
         # --- Initiate Playback ---
-        await _play_internal(guild_id, voice_client)
+        if guild_actors.superseded(guild_id):
+            raise OperationSuperseded() # A newer command is queued, don't spawn FFmpeg just to kill it
+        await _play_internal(guild_id, voice_client, trace=trace)
         return f"▶️ Now playing: `{stream_name}`"
 
+    except OperationSuperseded:
+        raise
     except asyncio.TimeoutError:
          logger.error(f"[{guild_id}] Timeout connecting/moving to voice channel: {voice_channel.name}")
-         guild_states[guild_id]['should_play'] = False
-         save_state()
+         state.should_play = False
+         save_state(guild_id)
          return "Error: Timed out connecting to the voice channel."
     except discord.errors.ClientException as e:
          logger.error(f"[{guild_id}] ClientException connecting/moving: {e}")
          # This might mean already connecting, check current state
          if guild.voice_client and guild.voice_client.is_connected():
               logger.warning(f"[{guild_id}] ClientException but already connected, attempting play anyway.")
-              guild_states[guild_id]['vc'] = guild.voice_client
-              await _play_internal(guild_id, guild.voice_client)
+              state.vc = guild.voice_client
+              if trace: trace.stage('connect')
+              await _play_internal(guild_id, guild.voice_client, trace=trace)
               return f"▶️ Now playing: `{stream_name}`"
          else:
-              guild_states[guild_id]['should_play'] = False
-              save_state()
+              state.should_play = False
+              save_state(guild_id)
               return f"Error connecting: {e}. Try `{COMMAND_PREFIX}leave` first."
     except Exception as e:
         logger.error(f"[{guild_id}] Error in ensure_voice_and_play for '{stream_name}': {e}", exc_info=True)
-        guild_states[guild_id]['should_play'] = False
-        save_state()
+        state.should_play = False
+        save_state(guild_id)
         return f"An error occurred: {e}"
 
+# --- Guild Command Actors ---
+# Playback operations (play, stop, leave, reconnect, resume, source restart) for one guild run one at a
+# time. A newer user operation supersedes the queued one, whose callers then get the newer result;
+# background operations collapse into whatever is already queued.
+
+class OperationSuperseded(Exception):
+    """Raised inside a running operation once a newer user operation for the guild is queued."""
+
+class GuildOperation:
+    __slots__ = ('kind', 'factory', 'background', 'waiters')
+
+    def __init__(self, kind: str, factory, background: bool, waiter: asyncio.Future):
+        self.kind = kind
+        self.factory = factory # Coroutine function, called when the operation runs
+        self.background = background
+        self.waiters = [waiter]
+
+class GuildActor:
+    """Serializes one guild's playback operations, keeping at most one queued behind the running one."""
+
+    def __init__(self, guild_id: int, actors: 'GuildActors'):
+        self.guild_id = guild_id
+        self._actors = actors
+        self.pending: GuildOperation | None = None
+        self.running: GuildOperation | None = None
+        self._task: asyncio.Task | None = None
+
+    def submit(self, kind: str, factory, background: bool) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        pending = self.pending
+        if pending is not None:
+            self._actors.collapsed += 1
+            if background: # Whatever is queued already decides what this guild should be doing
+                logger.info(f"[{self.guild_id}] Collapsed {kind} into queued {pending.kind}.")
+                pending.waiters.append(future)
+                return future
+            logger.info(f"[{self.guild_id}] Collapsed queued {pending.kind} into {kind}.")
+            operation = GuildOperation(kind, factory, background, future)
+            operation.waiters[:0] = pending.waiters # Superseded callers get the newer result
+        else:
+            operation = GuildOperation(kind, factory, background, future)
+        self.pending = operation
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return future
+
+    async def _run(self):
+        while self.pending is not None:
+            operation, self.pending = self.pending, None
+            self.running = operation
+            try:
+                result, error = await operation.factory(), None
+            except OperationSuperseded:
+                self._actors.collapsed += 1
+                logger.info(f"[{self.guild_id}] Running {operation.kind} superseded by queued {self.pending.kind}.")
+                self.pending.waiters[:0] = operation.waiters
+                continue
+            except Exception as e:
+                logger.exception(f"[{self.guild_id}] Unexpected error in {operation.kind} operation: {e}")
+                result, error = None, e
+            finally:
+                self.running = None
+            self._actors.completed += 1
+            for waiter in operation.waiters:
+                if waiter.done(): continue # Caller gave up waiting
+                if error: waiter.set_exception(error)
+                else: waiter.set_result(result)
+        if self._actors._actors.get(self.guild_id) is self:
+            del self._actors._actors[self.guild_id] # Idle guilds don't keep an actor around
+
+class GuildActors:
+    """Per-guild actors for playback operations."""
+
+    def __init__(self):
+        self._actors: dict[int, GuildActor] = {}
+        self.collapsed = 0 # Operations that never ran because a newer one replaced them
+        self.completed = 0
+
+    def submit(self, guild_id: int, kind: str, factory, background: bool = False) -> asyncio.Future:
+        """Queues factory() for the guild. background=True for automatic operations a user command should win over."""
+        actor = self._actors.get(guild_id)
+        if actor is None:
+            actor = self._actors[guild_id] = GuildActor(guild_id, self)
+        return actor.submit(kind, factory, background)
+
+    def superseded(self, guild_id: int) -> bool:
+        """Whether the guild's running operation has a user operation queued behind it."""
+        actor = self._actors.get(guild_id)
+        return actor is not None and actor.pending is not None and not actor.pending.background
+
+    def stats(self) -> dict:
+        return {'active': len(self._actors), 'queued': sum(1 for a in self._actors.values() if a.pending),
+                'collapsed': self.collapsed, 'completed': self.completed}
+
+guild_actors = GuildActors()
+
+# --- Player Event Bridge ---
+# discord.py calls `after` callbacks on each guild's audio player thread. The callback only records the
+# event; handling happens on the event loop, where a single consumer works through per-guild queues.
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list, 0.0 if it's empty."""
+    if not sorted_values: return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class PlayerEventBridge:
+    """Marshals 'playback ended' events from player threads onto the event loop."""
+
+    def __init__(self):
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._lock = threading.Lock()
+        self._incoming = [] # (guild_id, started_at, error, enqueued_at), appended by player threads
+        self._drain_scheduled = False
+        self._queues: dict[int, collections.deque] = {} # Per-guild events, handled in order
+        self._ready = collections.deque() # Guild IDs with queued events, served round-robin
+        self._consumer: asyncio.Task | None = None
+        self._latencies = collections.deque(maxlen=1024) # Seconds from player thread to handler, recent events
+        self.max_latency = 0.0
+        self.handled = 0
+        self.stale = 0 # Events for a playback that was already replaced
+
+    def after_callback(self, guild_id: int, started_at: float, source: HubSubscriber | None = None):
+        """Returns the `after` callback for the playback started at started_at. Call on the event loop.
+
+        discord.py only reports exceptions raised by the player itself, so a hub error that ended
+        source is taken from the source.
+        """
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        return functools.partial(self._from_player_thread, guild_id, started_at, source)
+
+    def _from_player_thread(self, guild_id: int, started_at: float, source: HubSubscriber | None, error: Exception | None):
+        if error is None and source is not None:
+            error = source._current_error
+        with self._lock:
+            self._incoming.append((guild_id, started_at, error, time.perf_counter()))
+            if self._drain_scheduled: return # The pending wakeup picks this event up too
+            self._drain_scheduled = True
+        try: self._loop.call_soon_threadsafe(self._drain)
+        except RuntimeError: pass # Loop already closed during shutdown
+
+    def _drain(self):
+        with self._lock:
+            incoming, self._incoming = self._incoming, []
+            self._drain_scheduled = False
+        for event in incoming:
+            guild_id = event[0]
+            queue = self._queues.get(guild_id)
+            if queue is None:
+                queue = self._queues[guild_id] = collections.deque()
+                self._ready.append(guild_id)
+            queue.append(event)
+        if self._consumer is None or self._consumer.done(): # Only runs while there is work
+            self._consumer = asyncio.create_task(self._consume())
+
+    async def _consume(self):
+        while self._ready:
+            guild_id = self._ready.popleft()
+            queue = self._queues[guild_id]
+            _, started_at, error, enqueued_at = queue.popleft()
+            if queue: self._ready.append(guild_id)
+            else: del self._queues[guild_id]
+            latency = time.perf_counter() - enqueued_at
+            self._latencies.append(latency)
+            self.max_latency = max(self.max_latency, latency)
+            state = guild_states.get(guild_id)
+            if state and state.playback_started_at != started_at:
+                self.stale += 1
+                logger.debug(f"[{guild_id}] Ignoring end event of a replaced playback.")
+            else:
+                try:
+                    after_playback_handler(guild_id, error)
+                    self.handled += 1
+                except Exception as e:
+                    logger.exception(f"[{guild_id}] Unexpected error handling playback end: {e}")
+            await asyncio.sleep(0) # Let other callbacks run between events
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        return {'pending': sum(len(queue) for queue in self._queues.values()), 'handled': self.handled,
+                'stale': self.stale, 'latency_p50': percentile(latencies, 0.5),
+                'latency_p99': percentile(latencies, 0.99), 'latency_max': self.max_latency}
+
+player_events = PlayerEventBridge()
+
+# --- Failure Recovery ---
+# Playback failures are classified by layer and only the failed layer is restarted: a dead upstream or
+# decoder respawns the audio source on the existing VoiceClient, only voice failures renegotiate voice.
+
+FAILURE_UPSTREAM, FAILURE_DECODER, FAILURE_VOICE = 'upstream', 'decoder', 'voice'
+
+def classify_playback_error(error: Exception) -> str:
+    """Which layer a playback error came from."""
+    if isinstance(error, UpstreamError): return FAILURE_UPSTREAM
+    if isinstance(error, StreamHubError): return FAILURE_DECODER
+    return FAILURE_VOICE # Raised by discord.py's player itself: encoder, socket or websocket
+
 def after_playback_handler(guild_id: int, error: Exception | None):
-    """Callback after playback ends or errors. Handles state and reconnection."""
+    """Handles the end of a playback (on the event loop, via player_events): state and layer-aware recovery."""
     state = guild_states.get(guild_id)
     if not state:
         logger.warning(f"[{guild_id}] after_playback_handler called but no state found.")
         return
 
-    should_play = state.get('should_play', False) # Check intent *before* modifying state
+    should_play = state.should_play # Check intent *before* modifying state
     logger.info(f"[{guild_id}] Playback finished/stopped. Error: {error}, should_play flag was: {should_play}")
 
-    # Cleanup embed regardless of error or should_play state
-    # Use create_task as this handler runs in a separate thread
-    asyncio.create_task(cleanup_now_playing_message(guild_id))
+    if error and should_play:
+        layer = classify_playback_error(error)
+        logger.error(f"[{guild_id}] Playback Error reported ({layer} layer): {error}")
+        started_at = state.playback_started_at
+        if state.url and started_at and time.monotonic() - started_at < PROBE_CACHE_FAILURE_WINDOW:
+            probe_cache.invalidate(state.url) # Failed right away, the cached input options may be wrong
+        state.retries = state.retries + 1
+        if state.retries > MAX_RECONNECT_ATTEMPTS:
+            logger.error(f"[{guild_id}] Max reconnect attempts ({MAX_RECONNECT_ATTEMPTS}) reached after error. Stopping playback permanently.")
+            reconnect_failures.inc(reason=layer)
+            state.should_play = False
+            save_state(guild_id) # Save the stopped state
+            asyncio.create_task(cleanup_now_playing_message(guild_id))
+            return
+        reconnect_attempts.inc(reason=layer)
+        incident = getattr(error, 'broadcast_id', None)
+        vc = state.vc
+        if layer != FAILURE_VOICE and vc and vc.is_connected():
+            # Voice is fine: respawn just the source and keep the Now Playing message
+            logger.warning(f"[{guild_id}] Restarting {layer} on the existing voice connection, attempt {state.retries}/{MAX_RECONNECT_ATTEMPTS}.")
+            asyncio.create_task(restart_stream_source(guild_id, failed_url=state.url, incident=incident))
+        else:
+            logger.warning(f"[{guild_id}] Playback error while should_play=True. Attempting reconnect {state.retries}/{MAX_RECONNECT_ATTEMPTS}.")
+            asyncio.create_task(cleanup_now_playing_message(guild_id))
+            # Schedule reconnect task
+            asyncio.create_task(reconnect_after_delay(guild_id, failed_url=state.url, incident=incident))
+        return
 
+    # Cleanup embed once playback is over
+    asyncio.create_task(cleanup_now_playing_message(guild_id))
     if error:
-        logger.error(f"[{guild_id}] Playback Error reported: {error}")
-        if should_play:
-            state['retries'] = state.get('retries', 0) + 1
-            if state['retries'] <= MAX_RECONNECT_ATTEMPTS:
-                logger.warning(f"[{guild_id}] Playback error while should_play=True. Attempting reconnect {state['retries']}/{MAX_RECONNECT_ATTEMPTS} in {RECONNECT_DELAY}s.")
-                # Schedule reconnect task
-                asyncio.create_task(reconnect_after_delay(guild_id))
-            else:
-                logger.error(f"[{guild_id}] Max reconnect attempts ({MAX_RECONNECT_ATTEMPTS}) reached after error. Stopping playback permanently.")
-                state['should_play'] = False
-                save_state() # Save the stopped state
-        else:
-            logger.info(f"[{guild_id}] Playback error occurred, but should_play=False (manual stop during error?). Not attempting reconnect.")
-            # Ensure state reflects stopped status
-            state['should_play'] = False
-            state['retries'] = 0
-            save_state()
+        logger.info(f"[{guild_id}] Playback error occurred, but should_play=False (manual stop during error?). Not attempting reconnect: {error}")
     else:
         # Playback finished without error (manual stop, or potentially stream ending cleanly - less common for radio)
         logger.info(f"[{guild_id}] Playback ended without error. Assuming manual stop or natural end.")
-        # Ensure state reflects stopped status
-        state['should_play'] = False
-        state['retries'] = 0
-        save_state()
-
-async def reconnect_after_delay(guild_id: int):
-    """Waits and then attempts to reconnect and play."""
-    await asyncio.sleep(RECONNECT_DELAY)
+    # Ensure state reflects stopped status
+    state.should_play = False
+    state.retries = 0
+    save_state(guild_id)
+
+async def wait_before_retry(guild_id: int, delay: float, failed_url: str | None,
+                            incident: int | None = None) -> GuildState | None:
+    """Records the failure, sleeps `delay`, then waits while the stream's circuit is open.
+
+    Returns the guild's state if it should still play, else None.
+    """
+    if failed_url:
+        stream_circuits.record_failure(failed_url, incident)
+    if delay > 0:
+        await asyncio.sleep(delay)
     state = guild_states.get(guild_id)
+    if state and state.should_play and state.url and stream_circuits.is_open(state.url):
+        stream_url = state.url
+        logger.info(f"[{guild_id}] Stream circuit for {stream_url} is open, waiting for the stream to recover.")
+        if not await stream_circuits.wait_until_closed(stream_url, STREAM_CIRCUIT_MAX_WAIT):
+            state = guild_states.get(guild_id)
+            if state and state.should_play and state.url == stream_url:
+                logger.error(f"[{guild_id}] Stream {stream_url} still down after {STREAM_CIRCUIT_MAX_WAIT}s. Stopping playback.")
+                reconnect_failures.inc(reason='circuit_open')
+                state.should_play = False
+                save_state(guild_id)
+                await cleanup_now_playing_message(guild_id)
+            return None
+        state = guild_states.get(guild_id)
     # Re-check state after delay
-    if not state or not state.get('should_play'):
-        logger.info(f"[{guild_id}] Reconnect cancelled after delay (state changed or removed).")
+    if not state or not state.should_play:
+        logger.info(f"[{guild_id}] Retry cancelled after delay (state changed or removed).")
+        return None
+    return state
+
+async def restart_stream_source(guild_id: int, failed_url: str | None = None, incident: int | None = None):
+    """Respawns the audio source on the guild's existing VoiceClient, falling back to a full reconnect if voice dropped."""
+    state = guild_states.get(guild_id)
+    attempt = state.retries if state else 1
+    delay = 0 if attempt <= 1 else reconnect_backoff(attempt - 1) # First restart is immediate
+    state = await wait_before_retry(guild_id, delay, failed_url, incident)
+    if not state: return
+    trace = ttfa_tracer.start(guild_id, state.url, TRIGGER_RESTART)
+    await guild_actors.submit(guild_id, 'restart', functools.partial(_restart_source_now, guild_id, trace), background=True)
+
+async def _restart_source_now(guild_id: int, trace: PlaybackTrace | None = None):
+    state = guild_states.get(guild_id)
+    if not state or not state.should_play: return
+    vc = state.vc
+    if not vc or not vc.is_connected():
+        logger.info(f"[{guild_id}] Voice connection gone before the source restart, reconnecting instead.")
+        asyncio.create_task(reconnect_after_delay(guild_id))
         return
+    if vc.is_playing() or vc.is_paused():
+        return # Something else (e.g. a play command) already started playback
+    if trace: trace.stage('queue')
+    await _play_internal(guild_id, vc, restart=True, trace=trace)
+
+async def reconnect_after_delay(guild_id: int, failed_url: str | None = None, incident: int | None = None):
+    """Waits (backoff, then the stream's circuit breaker) and then attempts to reconnect and play.
 
-    logger.info(f"[{guild_id}] Executing reconnect attempt {state.get('retries', '?')}")
-    voice_channel_id = state.get('voice_channel_id')
-    text_channel_id = state.get('text_channel_id')
-    stream_url = state.get('url')
-    stream_name = state.get('stream_name')
-    requester_id = state.get('requester_id')
+    failed_url is set when playback of that stream failed, which counts towards opening its circuit;
+    incident is the failed shared decoder's broadcast_id, if any.
+    """
+    state = guild_states.get(guild_id)
+    delay = reconnect_backoff(state.retries if state else 1)
+    logger.info(f"[{guild_id}] Reconnecting in {delay:.1f}s.")
+    state = await wait_before_retry(guild_id, delay, failed_url, incident)
+    if not state: return
+    trace = ttfa_tracer.start(guild_id, state.url, TRIGGER_RECONNECT) # Backoff and circuit waits are not counted
+    await guild_actors.submit(guild_id, 'reconnect', functools.partial(_reconnect_now, guild_id, trace), background=True)
+
+async def _reconnect_now(guild_id: int, trace: PlaybackTrace | None = None):
+    state = guild_states.get(guild_id)
+    if not state or not state.should_play: return # Stopped while queued
+    vc = state.vc
+    if vc and vc.is_connected() and (vc.is_playing() or vc.is_paused()):
+        source = vc.source
+        if isinstance(source, HubSubscriber) and source._broadcast.stream_url == state.url:
+            logger.info(f"[{guild_id}] Already playing {state.url}, dropping the queued reconnect.")
+            return # A play command queued ahead of us already recovered playback
+    logger.info(f"[{guild_id}] Executing reconnect attempt {state.retries}")
+    voice_channel_id = state.voice_channel_id
+    text_channel_id = state.text_channel_id
+    stream_url = state.url
+    stream_name = state.stream_name
+    requester_id = state.requester_id
 
     if not all([voice_channel_id, stream_url, stream_name]):
         logger.error(f"[{guild_id}] Cannot reconnect: Missing required state info (VC ID, URL, or Name). Stopping.")
-        state['should_play'] = False
-        save_state()
+        reconnect_failures.inc(reason='missing_state')
+        state.should_play = False
+        save_state(guild_id)
         return
 
     # Call the main function to handle connection and playing
-    await ensure_voice_and_play(guild_id, voice_channel_id, text_channel_id, stream_url, stream_name, requester_id, is_manual_play=False)
+    result = await ensure_voice_and_play(guild_id, voice_channel_id, text_channel_id, stream_url, stream_name, requester_id,
+                                         is_manual_play=False, trace=trace if trace and trace.stream_url == stream_url else None)
+    if not result.startswith("▶️"):
+        reconnect_failures.inc(reason='connect')
+    return result
+
+
+# --- Metadata Readers ---
+# Titles normally come from the playback connection (IcyStreamPipe). With ICY_INLINE_METADATA off, or for
+# streams the pipe hands to FFmpeg, one long-lived ICY connection per stream that guilds are playing pushes
+# titles as soon as they arrive.
+
+class IcyMetadataReader:
+    """Keeps one stream connected, parses metadata blocks as they arrive and publishes title changes."""
+
+    def __init__(self, stream_url: str, connect_semaphore: asyncio.Semaphore):
+        self.stream_url = stream_url
+        self._connect_semaphore = connect_semaphore
+        self._backoff = ICY_READER_BACKOFF_MIN
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+    async def _run(self):
+        while True:
+            try:
+                await self._read_stream()
+                logger.debug(f"Metadata connection for {self.stream_url} ended, reconnecting.")
+            except asyncio.CancelledError:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metadata_errors.inc(source='reader', error=type(e).__name__)
+                logger.warning(f"Metadata connection error for {self.stream_url}: {e}")
+            except Exception as e:
+                metadata_errors.inc(source='reader', error=type(e).__name__)
+                logger.exception(f"Unexpected error reading metadata for {self.stream_url}: {e}")
+            logger.debug(f"Reconnecting metadata reader for {self.stream_url} in {self._backoff}s.")
+            await asyncio.sleep(self._backoff)
+            self._backoff = min(self._backoff * 2, ICY_READER_BACKOFF_MAX)
+
+    async def _read_stream(self):
+        headers = {'Icy-Metadata': '1'}
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30) # Long-lived, but notice a silent upstream
+        async with self._connect_semaphore: # Bound concurrent handshakes, e.g. after a restart
+            started = time.perf_counter()
+            response = await bot.http_session.get(self.stream_url, headers=headers, timeout=timeout)
+            metadata_fetch_seconds.observe(time.perf_counter() - started, source='reader')
+        async with response:
+            if not 200 <= response.status < 300:
+                metadata_errors.inc(source='reader', error=f"http_{response.status}")
+                logger.debug(f"Metadata connection failed for {self.stream_url}, status: {response.status}")
+                return
+            metaint_header = response.headers.get('icy-metaint')
+            if not metaint_header:
+                logger.debug(f"Stream {self.stream_url} does not provide icy-metaint header.")
+                self._backoff = ICY_READER_BACKOFF_MAX # Not going to change soon, check rarely
+                update_stream_title(self.stream_url, None)
+                return
+            parser = IcyMetadataParser(int(metaint_header))
+            self._backoff = ICY_READER_BACKOFF_MIN # Connected fine, reset backoff
+            async for chunk in response.content.iter_any():
+                for record in parser.feed(chunk):
+                    if 'StreamTitle' in record:
+                        update_stream_title(self.stream_url, record['StreamTitle'] or None)
+
+class IcyReaderManager:
+    """Owns one IcyMetadataReader per stream that at least one guild is playing."""
+
+    def __init__(self):
+        self._readers: dict[str, IcyMetadataReader] = {}
+        self._connect_semaphore = asyncio.Semaphore(METADATA_CONNECT_CONCURRENCY)
+
+    def ensure(self, stream_url: str):
+        """Starts a reader for stream_url if none is running."""
+        if stream_url not in self._readers:
+            self._readers[stream_url] = IcyMetadataReader(stream_url, self._connect_semaphore)
+            logger.info(f"Started metadata reader for {stream_url}")
+
+    def sync(self, stream_urls: set[str]):
+        """Starts readers for stream_urls and stops every other one."""
+        for stream_url in stream_urls:
+            self.ensure(stream_url)
+        for stream_url in list(self._readers):
+            if stream_url not in stream_urls:
+                self._readers.pop(stream_url).stop()
+                logger.info(f"No guild listening anymore, stopped metadata reader for {stream_url}")
+
+    def stop_all(self):
+        self.sync(set())
+
+icy_readers = IcyReaderManager()
+
+stream_titles: dict[str, str | None] = {} # Last title seen per stream URL, from whichever source reads it
+
+def update_stream_title(stream_url: str, title: str | None):
+    """Records a stream's title and pushes it to the guilds playing it when it changed."""
+    if stream_url in stream_titles and stream_titles[stream_url] == title: return
+    stream_titles[stream_url] = title
+    logger.debug(f"New metadata for {stream_url}: {title}")
+    try:
+        publish_stream_metadata(stream_url, title, guilds_playing(stream_url))
+    except Exception as e:
+        logger.exception(f"Unexpected error publishing metadata for {stream_url}: {e}")
 
+def guilds_playing(stream_url: str) -> list[int]:
+    """Returns the guilds that currently intend to play stream_url."""
+    return list(guild_states.guilds_for_url(stream_url) & guild_states.playing)
 
-# --- Metadata Fetching Task ---
-@tasks.loop(seconds=METADATA_FETCH_INTERVAL)
-async def fetch_metadata_loop():
+def publish_stream_metadata(stream_url: str, metadata: str | None, guild_ids: list[int]):
+    """Applies a stream's current title to every listed guild still playing it, queueing embed edits where it changed."""
+    for guild_id in guild_ids:
+        state = guild_states.get(guild_id)
+        if not state or not state.should_play or state.url != stream_url:
+            continue # Guild stopped or switched streams in the meantime
+        if metadata and metadata != state.current_metadata:
+            logger.info(f"[{guild_id}] Updating metadata: '{metadata}'")
+            state.current_metadata = metadata
+            embed_updates.request(guild_id) # Edit the existing embed
+        elif not metadata and state.current_metadata is not None:
+            # Metadata disappeared, clear it
+            logger.info(f"[{guild_id}] Clearing previous metadata.")
+            state.current_metadata = None
+            embed_updates.request(guild_id)
+
+@tasks.loop(seconds=METADATA_SYNC_INTERVAL)
+async def sync_metadata_readers():
+    """Starts metadata readers for playing streams missed by _play_internal and drops unused readers and titles."""
     # Ensure session exists
     if not bot.http_session or bot.http_session.closed:
-        logger.warning("Metadata loop: aiohttp session closed or not initialized, skipping cycle.")
+        logger.warning("Metadata sync: aiohttp session closed or not initialized, skipping cycle.")
         # Attempt to recreate session if closed
         if bot.http_session and bot.http_session.closed:
              bot.http_session = aiohttp.ClientSession()
         return
+    playing_urls = {state.url for state in guild_states.playing_states() if state.url}
+    icy_readers.sync({url for url in playing_urls if not stream_hub.has_inline_metadata(url)})
+    for stream_url in list(stream_titles):
+        if stream_url not in playing_urls:
+            del stream_titles[stream_url]
+
+@sync_metadata_readers.before_loop
+async def before_metadata_loop():
+    await bot.wait_until_ready() # Wait for the bot to be ready
+
+# --- Auto-Resume Scheduler ---
 
-    # Iterate over a copy of keys in case state changes during iteration
-    active_guild_ids = list(guild_states.keys())
+class ResumeScheduler:
+    """Resumes saved guilds gradually after a restart.
 
-    for guild_id in active_guild_ids:
+    At most RESUME_CONCURRENCY resumes run at once and new ones start at RESUME_RATE per second,
+    so voice handshakes, FFmpeg spawns and embeds don't all hit Discord at the same moment.
+    Guilds with people waiting in the voice channel go first.
+    """
+
+    def __init__(self):
+        self.total = self.done = self.failed = 0
+        self.started_at = self.finished_at = None
+        self._last_report = 0.0
+
+    def start(self, guild_ids: list[int]):
+        ordered = sorted(guild_ids, key=self._human_listeners, reverse=True)
+        self.total, self.started_at = len(ordered), time.monotonic()
+        logger.info(f"Auto-resume: scheduling {self.total} guild(s), {RESUME_CONCURRENCY} at a time, {RESUME_RATE}/s.")
+        asyncio.create_task(self._run(ordered))
+
+    def _human_listeners(self, guild_id: int) -> int:
+        guild = bot.get_guild(guild_id)
         state = guild_states.get(guild_id)
-        # Check if bot should be playing and has necessary info
-        if state and state.get('should_play') and state.get('url') and state.get('vc') and state['vc'].is_playing():
-            stream_url = state['url']
-            logger.debug(f"[{guild_id}] Attempting metadata fetch for: {stream_url}")
-            metadata = None
-            try:
-                headers = {'Icy-Metadata': '1'}
-                # Short timeout to avoid blocking the loop for too long
-                async with bot.http_session.get(stream_url, headers=headers, timeout=aiohttp.ClientTimeout(total=5)) as response:
-                    if 200 <= response.status < 300:
-                        metaint_header = response.headers.get('icy-metaint')
-                        if metaint_header:
-                            try:
-                                metaint = int(metaint_header)
-                                # Read up to the metadata block + some buffer
-                                # Reading large amounts can be slow/memory intensive, be careful
-                                chunk = await response.content.readexactly(metaint + 256 * 16) # Read metadata interval + buffer for metadata length/content
-                                metadata_length = chunk[metaint] * 16 # Length byte after the interval
-                                if metadata_length > 0:
-                                     metadata_bytes = chunk[metaint + 1 : metaint + 1 + metadata_length]
-                                     metadata_text = metadata_bytes.decode('utf-8', errors='ignore').strip()
-                                     # Extract title using regex
-                                     match = re.search(r"StreamTitle='([^;]*)';", metadata_text)
-                                     if match:
-                                         metadata = match.group(1).strip()
-                                         logger.debug(f"[{guild_id}] Parsed metadata: {metadata}")
-                                     else:
-                                         logger.debug(f"[{guild_id}] Could not parse StreamTitle from metadata block: {metadata_text}")
-                                else:
-                                     logger.debug(f"[{guild_id}] Metadata block length is zero.")
-
-                            except (ValueError, IndexError, asyncio.exceptions.IncompleteReadError) as e:
-                                logger.debug(f"[{guild_id}] Error parsing metadata structure for {stream_url}: {e}")
-                            except Exception as e:
-                                logger.warning(f"[{guild_id}] Unexpected error processing metadata chunk for {stream_url}: {e}")
-                        else:
-                            logger.debug(f"[{guild_id}] Stream {stream_url} does not provide icy-metaint header.")
-                    else:
-                        logger.debug(f"[{guild_id}] Metadata fetch failed for {stream_url}, status: {response.status}")
-
-                # Update state and embed if metadata changed
-                if metadata and metadata != state.get('current_metadata'):
-                    logger.info(f"[{guild_id}] Updating metadata: '{metadata}'")
-                    state['current_metadata'] = metadata
-                    await send_or_edit_now_playing_embed(guild_id) # Edit the existing embed
-                elif not metadata and state.get('current_metadata') is not None:
-                     # Metadata disappeared, clear it
-                     logger.info(f"[{guild_id}] Clearing previous metadata.")
-                     state['current_metadata'] = None
-                     await send_or_edit_now_playing_embed(guild_id)
+        channel = guild.get_channel(state.voice_channel_id) if guild and state else None
+        if not isinstance(channel, discord.VoiceChannel): return 0
+        return sum(1 for member in channel.members if not member.bot)
+
+    async def _run(self, guild_ids: list[int]):
+        semaphore = asyncio.Semaphore(RESUME_CONCURRENCY)
+        tasks = []
+        for guild_id in guild_ids:
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(self._resume_one(guild_id, semaphore)))
+            await asyncio.sleep(1 / RESUME_RATE) # Ramp: spread starts out over time
+        await asyncio.gather(*tasks)
+        self.finished_at = time.monotonic()
+        logger.info(f"Auto-resume finished: {self.done - self.failed}/{self.total} guild(s) resumed, {self.failed} failed, "
+                    f"full recovery took {self.finished_at - self.started_at:.1f}s.")
+
+    async def _resume_one(self, guild_id: int, semaphore: asyncio.Semaphore):
+        try:
+            state = guild_states.get(guild_id)
+            if not state or not state.should_play or not state.is_resuming:
+                logger.info(f"[{guild_id}] Skipping auto-resume, state changed while queued.")
+                return
+            logger.info(f"[{guild_id}] Found resumable state. Attempting auto-play.")
+            trace = ttfa_tracer.start(guild_id, state.url, TRIGGER_RESUME)
+            result = await guild_actors.submit(guild_id, 'resume', functools.partial(self._resume_now, guild_id, trace), background=True)
+            if not (result or '').startswith("▶️"):
+                self.failed += 1
+                logger.warning(f"[{guild_id}] Auto-resume failed: {result}")
+        except Exception as e:
+            self.failed += 1
+            logger.exception(f"[{guild_id}] Unexpected error during auto-resume: {e}")
+        finally:
+            semaphore.release()
+            self.done += 1
+            self._report_progress()
 
+    @staticmethod
+    async def _resume_now(guild_id: int, trace: PlaybackTrace | None = None) -> str | None:
+        state = guild_states.get(guild_id)
+        if not state or not state.should_play or not state.is_resuming:
+            return None # A command got there first
+        return await ensure_voice_and_play(guild_id, state.voice_channel_id, state.text_channel_id, state.url,
+                                           state.stream_name, state.requester_id, is_manual_play=False, trace=trace)
+
+    def _report_progress(self):
+        now = time.monotonic()
+        if now - self._last_report < RESUME_PROGRESS_INTERVAL and self.done < self.total: return
+        self._last_report = now
+        elapsed = now - self.started_at
+        eta = elapsed / self.done * (self.total - self.done) if self.done else 0
+        logger.info(f"Auto-resume progress: {self.done}/{self.total} done ({self.failed} failed), {elapsed:.0f}s elapsed, ~{eta:.0f}s remaining.")
+
+    def progress(self) -> dict:
+        return {'total': self.total, 'done': self.done, 'failed': self.failed, 'finished': self.finished_at is not None,
+                'elapsed': ((self.finished_at or time.monotonic()) - self.started_at) if self.started_at else 0.0}
+
+resume_scheduler = ResumeScheduler()
+
+# --- Event Loop Lag Monitor ---
+# A timer samples how late the loop runs it. Every loop callback is also timed against LOOP_SLOW_CALLBACK (on by
+# default) by wrapping asyncio's private Handle._run, so each stall names the coroutine behind it. The wrapper is
+# skipped, leaving just the lag samples, where that internal isn't what we expect (other event loops, interpreter
+# changes); ASYNCIO_DEBUG=1 then still makes asyncio log callbacks slower than loop.slow_callback_duration.
+
+_ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+
+def describe_callback(handle: asyncio.Handle) -> tuple[str, str]:
+    """Returns (name, location) for what a loop handle runs; for task steps, the coroutine and where it suspended."""
+    callback = handle._callback
+    owner = getattr(callback, '__self__', None)
+    if isinstance(owner, asyncio.Task):
+        coro = innermost = current = owner.get_coro()
+        while getattr(getattr(current, 'cr_await', None), 'cr_frame', None) is not None:
+            current = current.cr_await # Follow the await chain to the coroutine that actually ran,
+            if not current.cr_frame.f_code.co_filename.startswith(_ASYNCIO_DIR):
+                innermost = current # ignoring asyncio's own (sleep, wait_for, ...)
+        name = f"task {getattr(coro, '__qualname__', repr(coro))}"
+        if innermost is not coro:
+            name += f" > {innermost.__qualname__}"
+        frame = getattr(innermost, 'cr_frame', None)
+        location = f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno}" if frame else 'finished'
+        return name, location
+    if isinstance(callback, functools.partial):
+        callback = callback.func
+    code = getattr(callback, '__code__', None)
+    location = f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}" if code else ''
+    return getattr(callback, '__qualname__', None) or repr(callback), location
+
+class LoopLagMonitor:
+    """Samples event loop lag continuously and attributes slow callbacks."""
+
+    MAX_OFFENDERS = 256 # Distinct callback names tracked
+
+    def __init__(self):
+        self.lag = 0.0 # Latest sample, seconds
+        self.samples = collections.deque(maxlen=LOOP_LAG_HISTORY)
+        self.stalls = collections.deque(maxlen=50) # (wall time, seconds, name, location), most recent last
+        self.offenders: dict[str, list] = {} # name -> [count, total seconds, max seconds]
+        self._task: asyncio.Task | None = None
+        self._original_run = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if ASYNCIO_DEBUG:
+            loop.set_debug(True)
+            loop.slow_callback_duration = LOOP_SLOW_CALLBACK or 0.1
+        if LOOP_SLOW_CALLBACK > 0 and self._original_run is None:
+            if isinstance(loop, asyncio.BaseEventLoop) and isinstance(getattr(asyncio.events.Handle, '_run', None), types.FunctionType):
+                self._install_callback_timer()
+            else:
+                logger.warning(f"LOOP_SLOW_CALLBACK isn't supported on this event loop ({type(loop).__name__}) or Python "
+                               f"{sys.version.split()[0]}; only lag is sampled. Use ASYNCIO_DEBUG=1 to find slow callbacks.")
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task: self._task.cancel()
+        if self._original_run is not None:
+            asyncio.events.Handle._run = self._original_run
+            self._original_run = None
+
+    def _install_callback_timer(self):
+        original_run = self._original_run = asyncio.events.Handle._run
+        record_stall, threshold, clock = self._record_stall, LOOP_SLOW_CALLBACK, time.perf_counter
+
+        def timed_run(handle):
+            started = clock()
+            original_run(handle)
+            elapsed = clock() - started
+            if elapsed >= threshold:
+                record_stall(handle, elapsed)
+
+        asyncio.events.Handle._run = timed_run # TimerHandle inherits it
+
+    def _record_stall(self, handle: asyncio.Handle, elapsed: float):
+        try:
+            name, location = describe_callback(handle)
+        except Exception:
+            name, location = repr(handle), ''
+        self.stalls.append((time.time(), elapsed, name, location))
+        offender = self.offenders.get(name)
+        if offender is None and len(self.offenders) < self.MAX_OFFENDERS:
+            offender = self.offenders[name] = [0, 0.0, 0.0]
+        if offender is not None:
+            offender[0] += 1
+            offender[1] += elapsed
+            offender[2] = max(offender[2], elapsed)
+        slow_callbacks.inc()
+        logger.warning(f"Event loop blocked for {elapsed * 1000:.0f} ms by {name} ({location})")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + LOOP_LAG_INTERVAL
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.lag = max(0.0, loop.time() - expected)
+            self.samples.append(self.lag)
+            loop_lag_seconds.observe(self.lag)
+
+    @property
+    def timing_callbacks(self) -> bool:
+        return self._original_run is not None
+
+    def stats(self) -> dict:
+        samples = sorted(self.samples)
+        return {'lag': self.lag, 'lag_p50': percentile(samples, 0.5), 'lag_p99': percentile(samples, 0.99),
+                'lag_max': samples[-1] if samples else 0.0, 'stalls': sum(o[0] for o in self.offenders.values())}
+
+    def top_offenders(self, limit: int = 5) -> list[tuple[str, list]]:
+        return sorted(self.offenders.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+
+loop_lag = LoopLagMonitor()
+
+# --- Sampling Profiler ---
+# Only exists while a profile is running: a background thread samples every thread's Python stack
+# (event loop, audio players, shared decoders, ...) via sys._current_frames(). Nothing is hooked otherwise.
+
+class ProfileResult:
+    def __init__(self, stacks: collections.Counter, samples: int, duration: float):
+        self.stacks = stacks # Folded stack (root first, ';'-separated) -> samples
+        self.samples = samples
+        self.duration = duration
+
+    def folded(self) -> str:
+        """Collapsed-stack text, ready for flamegraph.pl / speedscope / inferno."""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit: int) -> list[tuple[str, int]]:
+        """Innermost frames by sample count (self time)."""
+        self_counts = collections.Counter()
+        for stack, count in self.stacks.items():
+            self_counts[stack.rsplit(';', 1)[-1]] += count
+        return self_counts.most_common(limit)
+
+    def threads(self) -> list[tuple[str, int]]:
+        per_thread = collections.Counter()
+        for stack, count in self.stacks.items():
+            per_thread[stack.split(';', 1)[0]] += count
+        return per_thread.most_common()
+
+class SamplingProfiler:
+    """Wall-clock sampling profiler across all threads, one run at a time."""
+
+    def __init__(self):
+        self.running = False
+
+    @staticmethod
+    def _thread_label(thread: threading.Thread | None) -> str:
+        if thread is None: return 'unknown'
+        if thread is threading.main_thread(): return 'event-loop'
+        if isinstance(thread, discord.player.AudioPlayer): return 'audio-player'
+        return re.sub(r'\d+', 'N', thread.name.split(':', 1)[0]) # e.g. stream-hub:<url>, asyncio_N
+
+    @staticmethod
+    def _code_label(code) -> str:
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _sample(self, seconds: float) -> ProfileResult:
+        # Samples only collect code objects, labels are formatted once per distinct stack at the end
+        raw = collections.Counter() # (thread label, code objects innermost first) -> samples
+        own_ident = threading.get_ident()
+        samples = 0
+        started = time.perf_counter()
+        deadline = started + seconds
+        while time.perf_counter() < deadline:
+            threads = {thread.ident: thread for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident: continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                raw[(self._thread_label(threads.get(ident)), tuple(codes))] += 1
+            samples += 1
+            time.sleep(PROFILE_INTERVAL)
+        duration = time.perf_counter() - started
+        labels = {} # Code object -> label
+        stacks = collections.Counter()
+        for (thread_label, codes), count in raw.items():
+            frames = [thread_label]
+            for code in reversed(codes):
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = self._code_label(code)
+                frames.append(label)
+            stacks[';'.join(frames)] += count
+        return ProfileResult(stacks, samples, duration)
+
+    async def run(self, seconds: float) -> ProfileResult:
+        if self.running:
+            raise RuntimeError("A profile is already running.")
+        self.running = True
+        try:
+            logger.info(f"Sampling profiler running for {seconds:.0f}s.")
+            return await asyncio.to_thread(self._sample, seconds) # Off the loop, so the loop thread gets sampled too
+        finally:
+            self.running = False
+
+profiler = SamplingProfiler()
+
+# --- Metrics Endpoint ---
+
+def _gateway_latency() -> float | None:
+    latency = bot.latency
+    return latency if latency == latency and latency != float('inf') else None # NaN/inf until the first heartbeat
+
+def _player_event_latency() -> dict:
+    stats = player_events.stats()
+    return {(('quantile', '0.5'),): stats['latency_p50'], (('quantile', '0.99'),): stats['latency_p99']}
+
+metrics.gauge('radio_active_guilds', 'Guilds that should currently be playing.', lambda: len(guild_states.playing))
+metrics.gauge('radio_known_guilds', 'Guilds with playback state.', lambda: len(guild_states))
+metrics.gauge('radio_unique_streams', 'Streams with a running shared decoder.', lambda: stream_hub.stats()['streams'])
+metrics.gauge('radio_stream_subscribers', 'Guild players attached to shared decoders.', lambda: stream_hub.stats()['subscribers'])
+metrics.gauge('radio_ffmpeg_processes', 'Running FFmpeg decoder processes.', lambda: stream_hub.stats()['ffmpeg_processes'])
+metrics.gauge('radio_metadata_readers', 'Separate ICY metadata connections.', lambda: len(icy_readers._readers))
+metrics.gauge('radio_stream_circuits_open', 'Stream URLs whose circuit breaker is open.', lambda: stream_circuits.stats()['open'])
+metrics.gauge('radio_embed_queue_depth', 'Now Playing renders waiting to run.', lambda: embed_updates.stats()['queue_depth'])
+metrics.gauge('radio_embed_updates_coalesced_total', 'Now Playing updates merged into a pending one.',
+              lambda: embed_updates.stats()['coalesced'], metric_type='counter')
+metrics.gauge('radio_embed_render_cache_total', 'Now Playing renders served from the shared cache (hit) or built (miss).',
+              lambda: {(('result', 'hit'),): embed_render_cache.hits, (('result', 'miss'),): embed_render_cache.misses},
+              metric_type='counter')
+metrics.gauge('radio_guild_ops_collapsed_total', 'Playback operations collapsed into a newer one.',
+              lambda: guild_actors.stats()['collapsed'], metric_type='counter')
+metrics.gauge('radio_player_event_latency_seconds', 'Recent player thread to event loop callback latency.',
+              _player_event_latency)
+metrics.gauge('radio_ttfa_recent_seconds', 'Time to first audio over recent traces, by trigger and quantile.',
+              lambda: {(('quantile', q), ('trigger', trigger)): stats[key] for trigger, stats in ttfa_tracer.percentiles().items()
+                       for q, key in (('0.5', 'p50'), ('0.9', 'p90'), ('0.99', 'p99'))})
+metrics.gauge('radio_event_loop_lag_last_seconds', 'Latest event loop lag sample.', lambda: loop_lag.lag)
+metrics.gauge('radio_gateway_latency_seconds', 'Discord gateway heartbeat latency.', _gateway_latency)
+
+class MetricsServer:
+    """Optional aiohttp server exposing /metrics in the Prometheus text format."""
+
+    def __init__(self):
+        self._runner: web.AppRunner | None = None
+
+    async def start(self):
+        if self._runner or not METRICS_PORT: return
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle_metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+        except OSError as e:
+            logger.error(f"Could not start metrics endpoint on {METRICS_HOST}:{METRICS_PORT}: {e}")
+            await runner.cleanup()
+            return
+        self._runner = runner
+        logger.info(f"Metrics endpoint listening on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
 
-            except asyncio.TimeoutError:
-                logger.debug(f"[{guild_id}] Timeout fetching metadata for {stream_url}.")
-            except aiohttp.ClientError as e:
-                logger.warning(f"[{guild_id}] Network error fetching metadata for {stream_url}: {e}")
-            except Exception as e:
-                logger.exception(f"[{guild_id}] Unexpected error in metadata fetch loop for {stream_url}: {e}")
-        else:
-             logger.debug(f"[{guild_id}] Skipping metadata fetch (not playing or missing info).")
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=metrics.render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
 
+    async def stop(self):
+        runner, self._runner = self._runner, None
+        if runner: await runner.cleanup()
 
-@fetch_metadata_loop.before_loop
-async def before_metadata_loop():
-    await bot.wait_until_ready() # Wait for the bot to be ready
+metrics_server = MetricsServer()
 
 # --- Bot Events ---
 @bot.event
@@ -504,6 +2688,7 @@ async def on_ready():
     logger.info(f"Logged in as {bot.user.name} ({bot.user.id})")
     logger.info(f"Command Prefix: {COMMAND_PREFIX}")
     logger.info(f"discord.py version: {discord.__version__}")
+    logger.info(f"Memory: {memory_report()}")
     logger.info("------")
 
     if not hasattr(bot, 'synced_commands'): # Sync commands only once on first ready
@@ -517,42 +2702,39 @@ async def on_ready():
 
     if not hasattr(bot, 'loaded_state'): # Load state only once
         load_state()
+        probe_cache.load()
         bot.loaded_state = True
         logger.info("Attempting auto-resume for saved states...")
         # --- Auto-Resume Logic ---
-        for guild_id, state in list(guild_states.items()): # Iterate over copy
-            if state.get('is_resuming'): # Check the flag set during load_state
-                logger.info(f"[{guild_id}] Found resumable state. Attempting auto-play.")
-                vc_id = state.get('voice_channel_id')
-                txt_id = state.get('text_channel_id')
-                url = state.get('url')
-                name = state.get('stream_name')
-                req_id = state.get('requester_id')
-                if all([vc_id, url, name]):
-                    # Use create_task to avoid blocking on_ready
-                    asyncio.create_task(
-                        ensure_voice_and_play(guild_id, vc_id, txt_id, url, name, req_id, is_manual_play=False)
-                    )
+        resumable = []
+        for guild_id, state in guild_states.items(): # items() returns a copy
+            if state.is_resuming: # Check the flag set during load_state
+                if all([state.voice_channel_id, state.url, state.stream_name]):
+                    resumable.append(guild_id)
                 else:
                     logger.warning(f"[{guild_id}] Cannot auto-resume: Missing required state info.")
-                    state['should_play'] = False # Mark as not playing if info missing
-                    state['is_resuming'] = False
+                    state.should_play = False # Mark as not playing if info missing
+                    state.is_resuming = False
+        if resumable:
+            resume_scheduler.start(resumable) # Staggered in the background, doesn't block on_ready
 
     # Start background tasks if not already running
-    if not fetch_metadata_loop.is_running():
-        logger.info("Starting metadata fetch loop.")
-        fetch_metadata_loop.start()
+    if not sync_metadata_readers.is_running():
+        logger.info("Starting metadata reader sync loop.")
+        sync_metadata_readers.start()
 
     # --- Post-Reconnect Check ---
     # Check guilds where bot *thought* it was playing before disconnect
-    for guild_id, state in list(guild_states.items()):
+    for state in guild_states.playing_states():
+        guild_id = state.guild_id
         guild = bot.get_guild(guild_id)
-        if guild and state.get('should_play') and not state.get('is_resuming'): # Only check if not actively resuming
+        if guild and not state.is_resuming: # Only check if not actively resuming
             vc = guild.voice_client
             if not vc or not vc.is_connected():
                  logger.warning(f"[{guild_id}] Bot reconnected, but voice client is missing/disconnected while should_play=True. Attempting reconnect.")
                  # Reset retries for reconnect after gateway issues
-                 state['retries'] = 0
+                 state.retries = 0
+                 reconnect_attempts.inc(reason='gateway')
                  # Trigger reconnect logic
                  asyncio.create_task(reconnect_after_delay(guild_id))
 
@@ -574,57 +2756,52 @@ async def on_voice_state_update(member, before, after):
         if before.channel and not after.channel: # Bot disconnected from a channel
             logger.info(f"[{guild_id}] Bot disconnected from voice channel '{before.channel.name}'. Source: {'API' if after.channel is None else 'Moved'}")
             if state:
-                state['vc'] = None # Clear VC object
+                state.vc = None # Clear VC object
                 # Check if disconnect was expected (due to should_play=False)
-                if state.get('should_play'):
+                if state.should_play:
                     logger.warning(f"[{guild_id}] Bot disconnected unexpectedly while should_play=True! Attempting reconnect.")
-                    state['retries'] = 0 # Reset retries for unexpected disconnect
+                    state.retries = 0 # Reset retries for unexpected disconnect
+                    reconnect_attempts.inc(reason='disconnect')
                     asyncio.create_task(reconnect_after_delay(guild_id))
                 else:
                     logger.info(f"[{guild_id}] Bot disconnect was expected (should_play=False). Resetting state.")
-                    state['retries'] = 0
-                    save_state() # Save the stopped state
+                    state.retries = 0
+                    save_state(guild_id) # Save the stopped state
                     await cleanup_now_playing_message(guild_id)
 
         elif not before.channel and after.channel: # Bot connected to a channel
             logger.info(f"[{guild_id}] Bot connected to voice channel '{after.channel.name}'.")
             # Update state if needed (usually handled by ensure_voice_and_play)
-            if state: state['vc'] = member.guild.voice_client
+            if state: state.vc = member.guild.voice_client
 
         elif before.channel != after.channel: # Bot moved channels
              logger.info(f"[{guild_id}] Bot moved from '{before.channel.name}' to '{after.channel.name}'.")
-             if state: state['vc'] = member.guild.voice_client # Update VC
+             if state: state.vc = member.guild.voice_client # Update VC
 
 
 @bot.event
-async def on_reaction_add(reaction: discord.Reaction, user: discord.User | discord.Member):
-    """Handle stop reaction."""
-    if user.bot or not reaction.message.guild: return
+async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
+    """Handle stop reaction. Raw events fire even for messages no longer in discord.py's message cache."""
+    guild_id = guild_states.guild_for_message(payload.message_id) # O(1), and ignores every other message
+    if guild_id is None or payload.user_id == bot.user.id or str(payload.emoji) != STOP_REACTION: return
+    if payload.member and payload.member.bot: return
 
-    guild_id = reaction.message.guild.id
     state = guild_states.get(guild_id)
-
-    if state and str(reaction.emoji) == STOP_REACTION and reaction.message.id == state.get('now_playing_message_id'):
-        logger.info(f"[{guild_id}] Stop reaction detected from user {user.name} on message {reaction.message.id}")
-        vc = reaction.message.guild.voice_client
-        if vc and vc.is_connected():
-            state['should_play'] = False # Set intent *before* stopping
-            logger.info(f"[{guild_id}] Stopping playback via reaction.")
-            if vc.is_playing() or vc.is_paused():
-                vc.stop() # Triggers after_playback_handler -> save_state & cleanup
-            else: # If connected but not playing, still need to save state and clean embed
-                 save_state()
-                 await cleanup_now_playing_message(guild_id)
-            try: await reaction.remove(user)
-            except: pass # Ignore permission errors removing reaction
-            try: await reaction.message.channel.send(f"⏹️ Playback stopped by {user.mention}.", delete_after=10)
-            except: pass
-        else:
-            logger.info(f"[{guild_id}] Stop reaction detected, but bot not connected.")
-            # If message exists but bot isn't connected, ensure state is clean
-            state['should_play'] = False
-            save_state()
-            await cleanup_now_playing_message(guild_id)
+    if not state: return
+    user_name = payload.member.name if payload.member else payload.user_id
+    channel = bot.get_partial_messageable(payload.channel_id, guild_id=guild_id)
+    logger.info(f"[{guild_id}] Stop reaction detected from user {user_name} on message {payload.message_id}")
+    guild = bot.get_guild(guild_id)
+    vc = guild.voice_client if guild else None
+    logger.info(f"[{guild_id}] Stopping playback via reaction.")
+    await guild_actors.submit(guild_id, 'stop', functools.partial(stop_playback, guild_id)) # Same path as the stop command
+    if vc and vc.is_connected():
+        try: await channel.get_partial_message(payload.message_id).remove_reaction(payload.emoji, discord.Object(payload.user_id))
+        except: pass # Ignore permission errors removing reaction
+        try: await channel.send(f"⏹️ Playback stopped by <@{payload.user_id}>.", delete_after=10)
+        except: pass
+    else:
+        logger.info(f"[{guild_id}] Stop reaction detected, but bot not connected.")
 
 
 # --- Commands (Prefix & Slash) ---
@@ -689,9 +2866,11 @@ async def _play_command_logic(guild_id: int, user: discord.User | discord.Member
     elif not stream_url.startswith(('http://', 'https')):
          return f"Input `{stream_url}` is not a valid URL or predefined stream name. See `{COMMAND_PREFIX}list`."
 
-    # Call the core function
-    result = await ensure_voice_and_play(guild_id, voice_channel.id, text_channel_id, stream_url, stream_name, user.id, is_manual_play=True)
-    return result
+    # Call the core function, through the guild's actor so rapid commands collapse into the last one
+    trace = ttfa_tracer.start(guild_id, stream_url, TRIGGER_MANUAL)
+    play = functools.partial(ensure_voice_and_play, guild_id, voice_channel.id, text_channel_id, stream_url, stream_name, user.id,
+                             is_manual_play=True, trace=trace)
+    return await guild_actors.submit(guild_id, 'play', play)
 
 @bot.command(name='play', aliases=['p', 'stream'])
 async def play_prefix(ctx, *, stream_url_or_name: str):
@@ -708,12 +2887,16 @@ async def play_slash(interaction: discord.Interaction, stream: str):
 
 # Stop Command
 async def _stop_command_logic(guild_id: int):
+    return await guild_actors.submit(guild_id, 'stop', functools.partial(stop_playback, guild_id))
+
+async def stop_playback(guild_id: int) -> str:
+    """Stops the guild's playback. Runs as a guild actor operation."""
     state = guild_states.get(guild_id)
     guild = bot.get_guild(guild_id)
     vc = guild.voice_client if guild else None
 
     if state:
-        state['should_play'] = False # Signal intent
+        state.should_play = False # Signal intent
         logger.info(f"[{guild_id}] Stop command used, setting should_play=False.")
 
     if vc and vc.is_connected():
@@ -722,10 +2905,10 @@ async def _stop_command_logic(guild_id: int):
             vc.stop() # Triggers after_playback_handler -> save_state & cleanup
             return "⏹️ Playback stopped."
         else:
-             if state: save_state(); await cleanup_now_playing_message(guild_id) # Explicit cleanup if stopped but connected
+             if state: save_state(guild_id); await cleanup_now_playing_message(guild_id) # Explicit cleanup if stopped but connected
              return "Nothing was playing, but I am connected."
     else:
-        if state: save_state(); await cleanup_now_playing_message(guild_id) # Ensure cleanup if message exists but not connected
+        if state: save_state(guild_id); await cleanup_now_playing_message(guild_id) # Ensure cleanup if message exists but not connected
         return "Not currently connected to a voice channel."
 
 @bot.command(name='stop')
@@ -743,31 +2926,35 @@ async def stop_slash(interaction: discord.Interaction):
 # Leave Command
 @bot.command(name='leave', aliases=['dc'])
 async def leave_prefix(ctx):
-    guild_id = ctx.guild.id
+    await ctx.send(await guild_actors.submit(ctx.guild.id, 'leave', functools.partial(leave_voice, ctx.guild.id)))
+
+async def leave_voice(guild_id: int) -> str:
+    """Stops playback and disconnects. Runs as a guild actor operation."""
     state = guild_states.get(guild_id)
-    vc = ctx.guild.voice_client
+    guild = bot.get_guild(guild_id)
+    vc = guild.voice_client if guild else None
 
     if state:
-        state['should_play'] = False # Signal intent
+        state.should_play = False # Signal intent
         logger.info(f"[{guild_id}] Leave command used, setting should_play=False.")
-        save_state() # Save stopped state before disconnect
+        save_state(guild_id) # Save stopped state before disconnect
         await cleanup_now_playing_message(guild_id) # Explicit cleanup
 
     if vc and vc.is_connected():
         channel_name = vc.channel.name
         logger.info(f"[{guild_id}] Disconnecting from '{channel_name}' via command.")
         await vc.disconnect(force=False) # Triggers voice_state_update
-        await ctx.send(f"Left `{channel_name}`.")
+        return f"Left `{channel_name}`."
     else:
-        await ctx.send("Not currently connected.")
+        return "Not currently connected."
 
 # Now Command
 @bot.command(name='now', aliases=['np'])
 async def now_prefix(ctx):
     state = guild_states.get(ctx.guild.id)
-    if state and state.get('should_play') and state.get('vc') and state['vc'].is_playing():
+    if state and state.should_play and state.vc and state.vc.is_playing():
         logger.info(f"[{ctx.guild.id}] Resending Now Playing embed via command.")
-        await send_or_edit_now_playing_embed(ctx.guild.id, force_new=True) # Force recreate embed
+        await embed_updates.request(ctx.guild.id, force_new=True, priority=EMBED_PRIORITY_USER) # Force recreate embed
         try: await ctx.message.delete() # Clean up command message
         except: pass
     else:
@@ -778,13 +2965,103 @@ async def now_slash(interaction: discord.Interaction):
     try: await interaction.response.defer(ephemeral=True)
     except Exception as e: logger.error(f"[{interaction.guild_id}] Defer failed: {e}"); return
     state = guild_states.get(interaction.guild_id)
-    if state and state.get('should_play') and state.get('vc') and state['vc'].is_playing():
+    if state and state.should_play and state.vc and state.vc.is_playing():
         logger.info(f"[{interaction.guild_id}] Resending Now Playing embed via slash command.")
-        await send_or_edit_now_playing_embed(interaction.guild_id, force_new=True)
+        await embed_updates.request(interaction.guild_id, force_new=True, priority=EMBED_PRIORITY_USER)
         await interaction.followup.send("Showing current stream info.", ephemeral=True)
     else:
         await interaction.followup.send("Not currently playing anything.", ephemeral=True)
 
+# Diagnostics Command
+@bot.command(name='diag')
+@commands.is_owner()
+async def diag_prefix(ctx):
+    """Owner-only: event loop lag, the callbacks that stalled it, and queue/recovery counters."""
+    lag = loop_lag.stats()
+    embed = discord.Embed(title="🩺 Diagnostics", color=discord.Color.dark_grey())
+    gateway = _gateway_latency()
+    embed.add_field(name="Event Loop", inline=False,
+                    value=f"Lag now {lag['lag'] * 1000:.1f} ms, p50 {lag['lag_p50'] * 1000:.1f} ms, "
+                          f"p99 {lag['lag_p99'] * 1000:.1f} ms, max {lag['lag_max'] * 1000:.1f} ms\n"
+                          f"Gateway latency: {f'{gateway * 1000:.0f} ms' if gateway is not None else 'n/a'}\n"
+                          + (f"Slow callbacks (≥ {LOOP_SLOW_CALLBACK * 1000:.0f} ms): {lag['stalls']}" if loop_lag.timing_callbacks
+                           else "Slow callbacks: not timed (LOOP_SLOW_CALLBACK)"))
+    offenders = loop_lag.top_offenders()
+    if offenders:
+        embed.add_field(name="Top Offenders (total blocked time)", inline=False, value="\n".join(
+            f"`{name[:60]}` ×{count}, {total * 1000:.0f} ms total, max {worst * 1000:.0f} ms" for name, (count, total, worst) in offenders))
+    recent = list(loop_lag.stalls)[-5:]
+    if recent:
+        embed.add_field(name="Recent Stalls", inline=False, value="\n".join(
+            f"<t:{int(at)}:R> {elapsed * 1000:.0f} ms `{name[:50]}` {location}" for at, elapsed, name, location in reversed(recent)))
+    ttfa = ttfa_tracer.percentiles()
+    if ttfa:
+        embed.add_field(name="Time to First Audio", inline=False, value="\n".join(
+            f"**{trigger}** (n={stats['count']}): p50 {stats['p50']:.2f}s, p90 {stats['p90']:.2f}s, p99 {stats['p99']:.2f}s\n"
+            + " / ".join(f"{stage} {seconds * 1000:.0f}ms" for stage, seconds in stats['stages'].items())
+            for trigger, stats in ttfa.items()))
+    recent_plays = list(ttfa_tracer.recent)[-5:]
+    if recent_plays:
+        lines = []
+        for at, total, trace in reversed(recent_plays):
+            stage, duration = trace.slowest_stage()
+            lines.append(f"<t:{int(at)}:R> **{trace.trigger}** {total:.2f}s in `{trace.guild_id}`, slowest {stage} {duration * 1000:.0f} ms")
+        embed.add_field(name="Recent Plays", inline=False, value="\n".join(lines))
+    hub, actors, events, embeds = stream_hub.stats(), guild_actors.stats(), player_events.stats(), embed_updates.stats()
+    embed.add_field(name="Playback", inline=False,
+                    value=f"{len(guild_states.playing)} playing, {hub['streams']} stream(s), {hub['ffmpeg_processes']} FFmpeg\n"
+                          f"Ops queued {actors['queued']}, collapsed {actors['collapsed']}\n"
+                          f"Player events pending {events['pending']}, p99 {events['latency_p99'] * 1000:.1f} ms\n"
+                          f"Embed queue {embeds['queue_depth']}, rate limited {embeds['rate_limited']}")
+    resume = resume_scheduler.progress()
+    if resume['total']:
+        embed.add_field(name="Auto-Resume", inline=False,
+                        value=f"{resume['done']}/{resume['total']} done, {resume['failed']} failed, "
+                              f"{'finished' if resume['finished'] else 'running'} after {resume['elapsed']:.0f}s")
+    await ctx.send(embed=embed)
+
+# Profile Command
+async def _profile_command_logic(seconds: int) -> tuple[str | None, discord.Embed | None, discord.File | None]:
+    """Shared logic for prefix and slash profile commands. Returns (error, embed, attachment)."""
+    if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+        return f"Duration must be between 1 and {PROFILE_MAX_SECONDS} seconds.", None, None
+    try:
+        result = await profiler.run(seconds)
+    except RuntimeError as e:
+        return str(e), None, None
+    total = sum(result.stacks.values()) or 1
+    embed = discord.Embed(title="🔬 Profile", color=discord.Color.dark_grey(),
+                          description=f"{result.samples} samples over {result.duration:.1f}s across all threads (wall clock).")
+    embed.add_field(name="Top Functions (self)", inline=False, value="\n".join(
+        f"`{count / total:6.1%}` {name[:80]}" for name, count in result.top_functions(10)) or "No samples.")
+    embed.add_field(name="Threads", inline=False, value="\n".join(
+        f"`{count / total:6.1%}` {name}" for name, count in result.threads()[:10]) or "No samples.")
+    attachment = discord.File(io.BytesIO(result.folded().encode()), filename=f"profile-{int(time.time())}.folded")
+    return None, embed, attachment
+
+@bot.command(name='profile')
+@commands.is_owner()
+async def profile_prefix(ctx, seconds: int = 10):
+    """Owner-only: samples every thread for `seconds` and uploads collapsed stacks."""
+    await ctx.send(f"Profiling for {seconds}s...", delete_after=max(seconds, 5))
+    error, embed, attachment = await _profile_command_logic(seconds)
+    if error: await ctx.send(error)
+    else: await ctx.send(embed=embed, file=attachment)
+
+async def _is_owner_interaction(interaction: discord.Interaction) -> bool:
+    return await bot.is_owner(interaction.user)
+
+@bot.tree.command(name="profile", description="Owner only: profiles the running bot.")
+@discord.app_commands.describe(seconds=f"How long to sample (1-{PROFILE_MAX_SECONDS}s)")
+@discord.app_commands.default_permissions(administrator=True)
+@discord.app_commands.check(_is_owner_interaction)
+async def profile_slash(interaction: discord.Interaction, seconds: int = 10):
+    try: await interaction.response.defer(ephemeral=True)
+    except Exception as e: logger.error(f"[{interaction.guild_id}] Defer failed: {e}"); return
+    error, embed, attachment = await _profile_command_logic(seconds)
+    if error: await interaction.followup.send(error, ephemeral=True)
+    else: await interaction.followup.send(embed=embed, file=attachment, ephemeral=True)
+
 # --- Error Handlers ---
 @bot.event
 async def on_command_error(ctx, error):
@@ -812,6 +3089,10 @@ async def on_app_command_error(interaction: discord.Interaction, error: discord.
 
 # --- Graceful Shutdown ---
 async def close_sessions():
+    icy_readers.stop_all()
+    stream_circuits.stop_all()
+    loop_lag.stop()
+    await metrics_server.stop()
     if bot.http_session and not bot.http_session.closed:
         await bot.http_session.close()
         logger.info("Closed aiohttp session.")
@@ -819,7 +3100,7 @@ async def close_sessions():
 @bot.event
 async def on_close():
     logger.info("Bot is closing. Saving final state.")
-    save_state() # Save state on close
+    await state_writer.flush() # Save state on close
     await close_sessions()
 
 # --- Run the Bot ---
@@ -829,6 +3110,8 @@ async def main():
         if not BOT_TOKEN:
             logger.critical("CRITICAL ERROR: DISCORD_TOKEN environment variable not set.")
             return
+        loop_lag.start()
+        await metrics_server.start() # No-op unless METRICS_PORT is set
         try:
             await bot.start(BOT_TOKEN)
         except discord.errors.LoginFailure:
@@ -839,6 +3122,8 @@ async def main():
              logger.critical(f"CRITICAL ERROR running bot: {e}", exc_info=True)
         finally:
              logger.info("Bot process ending. Performing final cleanup.")
+             await state_writer.flush() # Write any pending state changes immediately
+             await probe_cache.flush() # And a probe cache write still pending
              await close_sessions() # Ensure session closed even on error exit
 
 
@@ -0,0 +1,81 @@
+"""Fuzz corpus for the ICY metadata parser: quoting, truncation, encodings and random chunk splits.
+
+Run from the repository root with: python -m pytest tests
+"""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bot import IcyMetadataParser, parse_icy_metadata # noqa: E402
+
+# (raw metadata block, expected fields)
+CORPUS = [
+    (b"StreamTitle='Artist - Song';", {'StreamTitle': 'Artist - Song'}),
+    (b"StreamTitle='Artist - Song';StreamUrl='http://example.com/a;b';",
+     {'StreamTitle': 'Artist - Song', 'StreamUrl': 'http://example.com/a;b'}),
+    (b"StreamTitle='Rock 'n' Roll';", {'StreamTitle': "Rock 'n' Roll"}),
+    (b"StreamTitle='a;b';", {'StreamTitle': 'a;b'}),
+    (b'StreamTitle="Double quoted";', {'StreamTitle': 'Double quoted'}),
+    (b"StreamTitle=Bare title;", {'StreamTitle': 'Bare title'}),
+    (b"StreamTitle='  padded  ';", {'StreamTitle': 'padded'}),
+    (b"StreamTitle='';", {'StreamTitle': ''}),
+    (b"StreamTitle='Truncated before the quo", {'StreamTitle': 'Truncated before the quo'}),
+    (b"StreamTitle='Truncated';StreamU", {'StreamTitle': 'Truncated'}),
+    (b"StreamTitle='Caf\xe9 del Mar';", {'StreamTitle': 'Café del Mar'}), # cp1252
+    (b"StreamTitle='\x93Quoted\x94 \x96 Dash';", {'StreamTitle': '“Quoted” – Dash'}), # cp1252 punctuation
+    ("StreamTitle='Sigur Rós - Hoppípolla';".encode('utf-8'), {'StreamTitle': 'Sigur Rós - Hoppípolla'}),
+    ("StreamTitle='東京';".encode('utf-8'), {'StreamTitle': '東京'}),
+    (b"StreamTitle='Padded';\0\0\0\0\0\0\0\0\0\0", {'StreamTitle': 'Padded'}),
+    (b"garbage without fields", {}),
+    (b"\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0", {}),
+]
+
+@pytest.mark.parametrize('raw, expected', CORPUS)
+def test_parse_block(raw, expected):
+    assert parse_icy_metadata(raw) == expected
+
+def build_stream(rng: random.Random, metaint: int, blocks: list[bytes]) -> tuple[bytes, bytes]:
+    """ICY stream of random audio with the given metadata blocks (or empty ones) between intervals."""
+    stream, audio = bytearray(), bytearray()
+    for block in blocks:
+        chunk = rng.randbytes(metaint)
+        stream += chunk
+        audio += chunk
+        padded = block + b'\0' * (-len(block) % 16)
+        stream.append(len(padded) // 16)
+        stream += padded
+    return bytes(stream), bytes(audio)
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_chunk_splits(seed):
+    rng = random.Random(seed)
+    metaint = rng.choice([1, 16, 255, 8192])
+    blocks = [rng.choice([b''] + [raw for raw, _ in CORPUS]) for _ in range(30)]
+    stream, audio = build_stream(rng, metaint, blocks)
+    expected = [parse_icy_metadata(block + b'\0' * (-len(block) % 16)) for block in blocks if block]
+    expected = [fields for fields in expected if fields]
+
+    parser = IcyMetadataParser(metaint)
+    records, audio_out, pos = [], bytearray(), 0
+    while pos < len(stream):
+        size = rng.choice([1, 2, 3, 15, 16, 17, rng.randint(1, 4096)])
+        records += parser.feed(stream[pos:pos + size], audio_out)
+        pos += size
+    assert records == expected
+    assert bytes(audio_out) == audio
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_bytes_never_raise(seed):
+    rng = random.Random(seed)
+    parser = IcyMetadataParser(rng.randint(1, 64))
+    for _ in range(200):
+        for record in parser.feed(rng.randbytes(rng.randint(0, 512))):
+            assert all(isinstance(key, str) and isinstance(value, str) for key, value in record.items())
+    assert len(parser._meta_buffer) <= 255 * 16
+
+def test_invalid_metaint():
+    with pytest.raises(ValueError):
+        IcyMetadataParser(0)